@@ -37,13 +37,16 @@ __license__ = "GNU GPL 2 or later"
 
 import pygtk
 pygtk.require('2.0')
-import fcntl, gobject, gtk, os, signal, sys, tempfile
+import fcntl, gobject, gtk, hashlib, os, signal, sys, tempfile
 
 TICK_INTERVAL = 5000          # Milliseconds of inactivity before save-to-disk
 HANDLE_SIZE   = 2             # Width of the window when "hidden"
 PAD_SIZE      = (0.45, 0.60)  # The size of the pad as decimal percentages.
 WRAP_MODE     = gtk.WRAP_WORD # Don't break up words when word-wrapping.
 DISK_FILE     = os.path.expanduser(os.path.join('~','.scratch'))
+JOURNAL       = True          # Append edits to DISK_FILE + '.journal' rather
+                              # than rewriting DISK_FILE on every save.
+COMPACT_SIZE  = 1024 * 1024   # Journal size (bytes) which triggers a rewrite
 
 try:
 	import gtksourceview
@@ -61,10 +64,13 @@ except ImportError:
 class ScratchTray:
     has_mouse, has_keyboard = False, False
     pending_timeout = None
+    journal = None
 
-    def __init__(self, diskFile=DISK_FILE):
+    def __init__(self, diskFile=DISK_FILE, journal=JOURNAL):
         # create the widgets
         self.diskFile = diskFile
+        self.journalFile = journal and diskFile + '.journal' or None
+        self.edits, self.journaled = [], 0
         self.window = gtk.Window(gtk.WINDOW_TOPLEVEL)
         self.frame = gtk.Frame()
 
@@ -82,10 +88,13 @@ class ScratchTray:
         self.sw.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
         self.pad.set_wrap_mode(WRAP_MODE)
 
+        # (Binary mode so the journal's offsets always match what was saved)
+        snapshot = ''
         try:
             if os.path.exists(diskFile):
-                self.fh = open(diskFile,'rU+')
-                self.buf.set_text(self.fh.read())
+                self.fh = open(diskFile,'rb+')
+                snapshot = self.fh.read()
+                self.buf.set_text(snapshot)
             else:
                 self.fh = open(diskFile,'w')
             # Prevent two copies from walking over each others' data.
@@ -94,6 +103,16 @@ class ScratchTray:
             print "ERROR: Could not acquire exclusive lock on data file."
             sys.exit(0)
 
+        # Apply any edits which hadn't been compacted into diskFile yet.
+        if self.journalFile:
+            try:
+                if self.replayJournal(snapshot):
+                    self.compact()
+                else:
+                    self.resetJournal(snapshot)
+            except IOError, (errnum, errmsg):
+                self.showSaveError(errmsg)
+
 		# This has to be done before hooking the changed event to be effective.
         self.buf.set_modified(False)
         self.pad.set_editable(True)
@@ -106,6 +125,9 @@ class ScratchTray:
         self.window.connect("focus-out-event", self.cb_event_toggle, 'has_keyboard', False)
         self.window.connect('drag_motion', self.cb_drag_motion)
         self.buf.connect("changed", self.cb_modified)
+        if self.journalFile:
+            self.buf.connect("insert-text", self.cb_insert_text)
+            self.buf.connect("delete-range", self.cb_delete_range)
         self.screen.connect("size-changed", self.update_pad_geom)
         self.window.drag_dest_set(0, [], 0)
 
@@ -128,32 +150,124 @@ class ScratchTray:
         self.pad_geom = gtk.gdk.Rectangle(x, y, width, height)
         self.updatePos()
 
-    def saveScratch(self):
-        if self.buf.get_modified():
-            start, end = self.buf.get_bounds()
-            chars = self.buf.get_slice(start, end, False)
-            try:
-                fd, fn = tempfile.mkstemp(prefix='.',dir=os.path.dirname(self.diskFile),text=True)
-                file = os.fdopen(fd, 'w')
-                file.write(chars)
-                file.flush()
-                os.fsync(file.fileno())
-
-                self.fh.close()
-                self.fh = file
-                fcntl.flock(self.fh, fcntl.LOCK_EX)
-                os.rename(fn, self.diskFile)
-
-                self.buf.set_modified(False)
-            except IOError, (errnum, errmsg):
-                err = "Unable to save contents.  Error writing to '%s': %s" % (self.diskFile, errmsg)
-                dialog = gtk.MessageDialog(self.window, gtk.DIALOG_MODAL, gtk.MESSAGE_ERROR, gtk.BUTTONS_OK, err)
-                dialog.set_title("ScratchTray")
-                dialog.run()
-                dialog.destroy()
+    def saveScratch(self, compact=False):
+        """Save any changes, either by appending them to the journal or, when
+        journaling is disabled or C{compact} is set, by rewriting diskFile.
+
+        (The journal is also compacted whenever it grows past COMPACT_SIZE)
+        """
+        try:
+            if self.journal and self.edits and not compact:
+                self.appendJournal()
+                if self.journaled > COMPACT_SIZE:
+                    self.compact()
+            elif self.buf.get_modified() or (compact and self.journaled):
+                self.compact()
+        except IOError, (errnum, errmsg):
+            self.showSaveError(errmsg)
+
+    def showSaveError(self, errmsg):
+        err = "Unable to save contents.  Error writing to '%s': %s" % (self.diskFile, errmsg)
+        dialog = gtk.MessageDialog(self.window, gtk.DIALOG_MODAL, gtk.MESSAGE_ERROR, gtk.BUTTONS_OK, err)
+        dialog.set_title("ScratchTray")
+        dialog.run()
+        dialog.destroy()
+
+    def compact(self):
+        """Write the whole buffer to diskFile and start a new, empty journal."""
+        start, end = self.buf.get_bounds()
+        chars = self.buf.get_slice(start, end, False)
+
+        fd, fn = tempfile.mkstemp(prefix='.',dir=os.path.dirname(self.diskFile),text=True)
+        file = os.fdopen(fd, 'w')
+        file.write(chars)
+        file.flush()
+        os.fsync(file.fileno())
+
+        self.fh.close()
+        self.fh = file
+        fcntl.flock(self.fh, fcntl.LOCK_EX)
+        os.rename(fn, self.diskFile)
+
+        # If we crash before this, the old journal won't match the new
+        # snapshot and will be ignored by replayJournal().
+        if self.journalFile:
+            self.resetJournal(chars)
+        self.edits = []
+        self.buf.set_modified(False)
+
+    def journalHeader(self, snapshot):
+        """Identify the diskFile contents a journal's edits apply to."""
+        return "ScratchTray journal %s\n" % hashlib.md5(snapshot).hexdigest()
+
+    def resetJournal(self, snapshot):
+        """Atomically replace the journal with an empty one for C{snapshot}."""
+        fd, fn = tempfile.mkstemp(prefix='.',dir=os.path.dirname(self.journalFile))
+        journal = os.fdopen(fd, 'ab')
+        journal.write(self.journalHeader(snapshot))
+        journal.flush()
+        os.fsync(journal.fileno())
+        os.rename(fn, self.journalFile)
+
+        if self.journal:
+            self.journal.close()
+        self.journal, self.journaled = journal, 0
+
+    def appendJournal(self):
+        """Append the edits recorded since the last save to the journal."""
+        records = ''.join(self.edits)
+        self.journal.write(records)
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+        self.journaled += len(records)
+        self.edits = []
+        self.buf.set_modified(False)
+
+    def replayJournal(self, snapshot):
+        """Apply the journaled edits for C{snapshot} to the buffer.
+
+        Each record is either C{+<offset> <bytes>\\n<text>} or
+        C{-<offset> <chars>\\n} with offsets counted in characters.
+
+        @return: Whether diskFile needs to be rewritten. (There were edits, or
+            the journal was stale or damaged)
+        """
+        try:
+            journal = open(self.journalFile, 'rb')
+        except IOError:
+            return False
+
+        with journal:
+            if journal.readline() != self.journalHeader(snapshot):
+                return True
+
+            replayed = False
+            while True:
+                record = journal.readline()
+                if not record:
+                    break
+                try:
+                    offset, size = [int(x) for x in record[1:].split()]
+                    if not record.endswith('\n') or record[0] not in '+-':
+                        raise ValueError
+                except ValueError:
+                    return True  # Torn by a crash mid-write. Stop here.
+
+                start = self.buf.get_iter_at_offset(offset)
+                if record[0] == '+':
+                    text = journal.read(size)
+                    if len(text) < size:
+                        return True
+                    self.buf.insert(start, text)
+                else:
+                    self.buf.delete(start, self.buf.get_iter_at_offset(offset + size))
+                replayed = True
+        return replayed
 
     def onExit(self):
-        self.saveScratch()
+        # Leave a complete diskFile behind for anything else that reads it.
+        self.saveScratch(compact=True)
         self.fh.close()
 
     def updatePos(self):
@@ -178,6 +292,12 @@ class ScratchTray:
         setattr(self, 'has_mouse', True)
         self.updatePos()
 
+    def cb_insert_text(self, buf, location, text, length):
+        self.edits.append('+%d %d\n%s' % (location.get_offset(), len(text), text))
+
+    def cb_delete_range(self, buf, start, end):
+        self.edits.append('-%d %d\n' % (start.get_offset(), end.get_offset() - start.get_offset()))
+
     def cb_modified(self, buf):
         if self.pending_timeout:
             gobject.source_remove(self.pending_timeout)
@@ -14,6 +14,31 @@ scripts. Other languages under consideration.
 Non-obvious Features:
 - Hyperlinks URLs and obfuscates e-mail addresses in script descriptions.
 - Configurable license name hyperlinking
+- Parsed metadata is cached (in CACHE_FILE) and only regenerated for scripts
+  whose size or mtime has changed.
+- The generated pages are also cached (in PAGE_CACHE_DIR) and served with
+  ETag and Last-Modified headers so repeat visitors get a 304 Not Modified.
+- The page is streamed as it's generated and gzip-compressed for browsers
+  which accept it.
+- Each file is opened at most once per run and, when there are a lot of new
+  or changed scripts to parse, they're parsed on a pool of processes.
+- Can also run as a persistent WSGI application (see L{ListingApp}), which
+  keeps parsed metadata and the rendered page in memory between requests.
+- C{--offline} builds are incremental: unchanged entries reuse their cached
+  HTML, unchanged files aren't rewritten, and gzip (plus brotli, if the
+  module is installed) copies are generated for the server to send as-is.
+- Raw files (C{?get=}) are streamed in chunks (or handed off to the server's
+  C{wsgi.file_wrapper}, which may use C{sendfile}) with validators and
+  support for conditional and C{Range} requests.
+- Each listing has a search box which filters the scripts client-side
+  using a compact JSON inverted index (C{?search=1}, or C{search.json} when
+  built C{--offline}) of their names, descriptions, licenses and languages.
+- Opt-in timing of each phase (directory scan, metadata extraction,
+  description markup, rendering) via C{--profile} (a report of the slowest
+  scripts) or L{PROFILE} (a C{Server-Timing} header on each response).
+- Subdirectories are listed as categories, each with its own page (and
+  C{index.html} when built C{--offline}) which is only generated and cached
+  when it's requested. Large categories can optionally be paginated.
 
 Warnings:
 - The HTML templating is a quick hackjob. I'm not kidding.
@@ -21,7 +46,6 @@ Warnings:
 
 TODO:
 - Switch to a proper templating solution? (No longer a single-file script)
-- Add caching eventually (current run time for my site, 0.1 seconds)
 - Add a 5px inset border and subtle "rounded CRT glare" gradients to <pre>
 """
 
@@ -30,11 +54,58 @@ __author__  = "Stephan Sokolow (deitarion/SSokolow)"
 __version__ = "0.3.1"
 __license__ = "GNU GPL 2.0 or later"
 
-import cgi, os, parser, re, time, token, urllib
+import cPickle, email.utils, gzip, hashlib, json, os, posixpath, re, stat
+import tempfile, threading, time, token, tokenize, urllib, zlib
+from cStringIO import StringIO
+from urlparse import parse_qs
 from xml.sax.saxutils import escape as xml_escape
 
+try:
+    import parser  # Only needed as a fallback for odd files
+except ImportError:
+    parser = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 DEFAULT_LICENSE = "GNU GPL 2.0 or newer"
 
+# Where to persist parsed script metadata between requests. Since the caches
+# are unpickled, this must be somewhere only our own user can write to.
+# (Set to None to disable caching)
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                         os.path.expanduser(os.path.join('~', '.cache')),
+                         'lazybones')
+CACHE_FILE = CACHE_DIR and os.path.join(CACHE_DIR, 'metadata.cache')
+PAGE_CACHE_DIR = CACHE_DIR and os.path.join(CACHE_DIR, 'pages')
+
+HEAD_SIZE = 4096            # How much of each file to read when classifying
+PARALLEL_THRESHOLD = 32     # Parse on a process pool if this many need it
+
+# In persistent (WSGI) mode, how long to trust the in-memory page when the
+# directory's mtime hasn't changed. (Catches scripts edited in place, which
+# doesn't touch the directory's mtime)
+HOT_CACHE_TTL = 10
+
+FILE_CHUNK_SIZE = 65536     # Read size when streaming raw files
+
+# Scripts per page when running as a CGI/WSGI app. (0 to disable pagination)
+PAGE_SIZE = 0
+
+# Add a Server-Timing header breaking down where the time went to each
+# response. (Responses are buffered rather than streamed when enabled)
+PROFILE = False
+
 LICENSES = {
         re.compile("(^|\b)((GNU )?(A|Affero )(General Public License|GPL)[ ]?v?3(\.0)?)", re.IGNORECASE): "http://www.gnu.org/licenses/agpl-3.0.html",
         re.compile("(^|\b)((GNU )?(General Public License|GPL)[ ]?v?2(\.0)?)", re.IGNORECASE): "http://www.gnu.org/licenses/gpl-2.0.html",
@@ -57,6 +128,35 @@ HTACCESS = """
 Options -ExecCGI
 SetHandler default-handler
 DirectoryIndex index.html
+
+# Serve the precompressed copies of index.html and search.json generated
+# by --offline
+<IfModule mod_rewrite.c>
+    RewriteEngine On
+
+    RewriteCond "%{HTTP:Accept-Encoding}" "br"
+    RewriteCond "%{REQUEST_FILENAME}.br" -s
+    RewriteRule "^(.*)\\.(html|json)$" "$1.$2.br" [QSA,L]
+
+    RewriteCond "%{HTTP:Accept-Encoding}" "gzip"
+    RewriteCond "%{REQUEST_FILENAME}.gz" -s
+    RewriteRule "^(.*)\\.(html|json)$" "$1.$2.gz" [QSA,L]
+
+    RewriteRule "\\.html\\.br$" "-" [T=text/html,E=no-brotli:1,E=no-gzip:1]
+    RewriteRule "\\.html\\.gz$" "-" [T=text/html,E=no-brotli:1,E=no-gzip:1]
+    RewriteRule "\\.json\\.br$" "-" [T=application/json,E=no-brotli:1,E=no-gzip:1]
+    RewriteRule "\\.json\\.gz$" "-" [T=application/json,E=no-brotli:1,E=no-gzip:1]
+</IfModule>
+<IfModule mod_headers.c>
+    <FilesMatch "\\.(html|json)\\.br$">
+        Header append Content-Encoding br
+        Header append Vary Accept-Encoding
+    </FilesMatch>
+    <FilesMatch "\\.(html|json)\\.gz$">
+        Header append Content-Encoding gzip
+        Header append Vary Accept-Encoding
+    </FilesMatch>
+</IfModule>
 """
 
 PAGE_HEADER = """<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01//EN"
@@ -146,6 +246,10 @@ PAGE_HEADER = """<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01//EN"
                 padding-left: 0;
                 text-align: center;
             }
+            .menu #search {
+                box-sizing: border-box;
+                width: 100%;
+            }
 
             @media (max-width: 965px) {
                 .menu {
@@ -202,9 +306,92 @@ BODY_HEADER = """
         </div>
 """
 
+SEARCH_BOX = """<input type="search" id="search" placeholder="Filter scripts..."
+    data-index="%(index_url)s" data-page="%(page)d" data-page-url="%(page_url)s"
+    style="display: none">"""
+
+# Filters the listing using the index from L{build_search_index}. Words must
+# all match (as prefixes of indexed terms) and matches on other pages of a
+# paginated listing are offered as links.
+SEARCH_SCRIPT = """
+        <div id="search_results" style="display: none"></div>
+        <script type="text/javascript">
+          (function() {
+            var box = document.getElementById("search"),
+                results = document.getElementById("search_results"),
+                index = null, loading = false, tocLinks = {};
+            if (!box || !window.XMLHttpRequest || !window.JSON) { return; }
+            box.style.display = "";
+
+            var links = document.querySelectorAll(".menu li a");
+            for (var i = 0; i < links.length; i++) {
+              tocLinks[links[i].getAttribute("href").slice(1)] = links[i].parentNode;
+            }
+
+            function lookup(word) {
+              var found = {};
+              for (var term in index.terms) {
+                if (term.lastIndexOf(word, 0) === 0) {
+                  var docs = index.terms[term];
+                  for (var j = 0; j < docs.length; j++) { found[docs[j]] = true; }
+                }
+              }
+              return found;
+            }
+
+            function filter() {
+              var words = box.value.toLowerCase().match(/[a-z0-9]+/g) || [],
+                  matches = null, elsewhere = [], i;
+              for (i = 0; i < words.length; i++) {
+                var found = lookup(words[i]);
+                if (matches) {
+                  for (var doc in matches) {
+                    if (!found[doc]) { delete matches[doc]; }
+                  }
+                } else { matches = found; }
+              }
+
+              var page = box.getAttribute("data-page");
+              for (i = 0; i < index.docs.length; i++) {
+                var doc = index.docs[i], shown = !matches || !!matches[i],
+                    heading = document.getElementById(doc[0]);
+                if (heading) {
+                  heading.parentNode.style.display = shown ? "" : "none";
+                  if (tocLinks[doc[0]]) {
+                    tocLinks[doc[0]].style.display = shown ? "" : "none";
+                  }
+                } else if (shown && matches && String(doc[2]) !== page) {
+                  elsewhere.push("<li><a href='" + box.getAttribute("data-page-url") +
+                    doc[2] + "#" + doc[0] + "'>" + doc[1] + "</a></li>");
+                }
+              }
+              results.innerHTML = elsewhere.length ?
+                "<h2>Matches on other pages</h2><ul>" + elsewhere.join("") + "</ul>" : "";
+              results.style.display = elsewhere.length ? "" : "none";
+            }
+
+            function load() {
+              if (index || loading) { return; }
+              loading = true;
+              var xhr = new XMLHttpRequest();
+              xhr.onreadystatechange = function() {
+                if (xhr.readyState === 4 && xhr.status === 200) {
+                  index = JSON.parse(xhr.responseText);
+                  filter();
+                }
+              };
+              xhr.open("GET", box.getAttribute("data-index"), true);
+              xhr.send();
+            }
+
+            box.onfocus = load;
+            box.oninput = box.onkeyup = function() { if (index) { filter(); } };
+          })();
+        </script>"""
+
 PAGE_FOOTER = """
         <div class='footer'>
-        <span class='generated'>""" + time.strftime("This page generated at %Y-%m-%d %H:%M UTC", time.gmtime()) + """</span>
+        <span class='generated'>This page generated at %(generated)s</span>
         </div>
         <!-- Piwik -->
         <script type="text/javascript">
@@ -225,6 +412,11 @@ PAGE_FOOTER = """
     </body>
 </html>"""
 
+def page_footer():
+    """Return L{PAGE_FOOTER} stamped with the current time."""
+    return PAGE_FOOTER % {'generated': time.strftime("%Y-%m-%d %H:%M UTC",
+                                                     time.gmtime())}
+
 #TODO: Make use of this regex to sanitize input before using it in HTML/XML.
 #(Should also be sanitizing 0xD800-0xDFFF, 0xFFFE-0xFFFF, and 0x110000, but
 # that has to wait until I've added support for parsing and honoring encoding
@@ -238,6 +430,89 @@ _bc = r"""!@#$%^&*()=+{}[\]|\;:'"/?>,<\s"""
 email_address_re     = re.compile(r"""(?P<email>[^%s]+@[^%s]+\.[^%s]*[^.%s])""" % (_bc, _bc, _bc, _bc), re.UNICODE)
 del _bc
 
+# Neither of the above can contain whitespace, so only the whitespace-delimited
+# tokens containing an "@" or "://" need to be run through them.
+markup_token_re      = re.compile(r"""(?<!\S)\S*?(?:@|://)\S*""", re.UNICODE)
+
+def _combine_licenses(licenses):
+    """Merge the patterns from L{LICENSES} into a single regex.
+
+    @returns: C{(regex, [(group, url), ...])} where C{group} is the number of
+        the group holding the license name when that alternative matches.
+    """
+    # Reversed so that, as when each was applied in turn, the last wins ties
+    parts, groups, flags, offset = [], [], 0, 0
+    for regex, url in reversed(LICENSES.items()):
+        parts.append('(?:%s)' % regex.pattern)
+        groups.append((offset + 2, url))
+        offset += regex.groups
+        flags |= regex.flags
+    return re.compile('|'.join(parts), flags), groups
+
+licenses_re, _license_groups = _combine_licenses(LICENSES)
+
+class Timings(object):
+    """Accumulates how long each phase of generating a listing took, both
+    in total and per script. (See L{measure})"""
+    phases = (('scan', 'Directory scan'), ('parse', 'Metadata extraction'),
+              ('markup', 'Description markup'), ('render', 'Rendering'))
+
+    def __init__(self):
+        self.started = time.time()
+        self.totals = dict.fromkeys(dict(self.phases), 0.0)
+        self.entries = {}
+
+    def add(self, phase, elapsed, filepath=None):
+        self.totals[phase] += elapsed
+        if filepath:
+            entry = self.entries.setdefault(filepath,
+                                            dict.fromkeys(self.totals, 0.0))
+            entry[phase] += elapsed
+
+    def server_timing(self):
+        """Format the totals as the value of a C{Server-Timing} header."""
+        metrics = ['%s;dur=%.1f;desc="%s"' % (name, self.totals[name] * 1000,
+                                              desc)
+                   for name, desc in self.phases]
+        metrics.append('total;dur=%.1f' % ((time.time() - self.started) * 1000))
+        return ', '.join(metrics)
+
+    def report(self, limit=10):
+        """Format the totals and the C{limit} slowest scripts as text."""
+        lines = ['Phase totals (ms):']
+        for name, desc in self.phases:
+            lines.append('  %-8s %9.2f  %s' % (name, self.totals[name] * 1000,
+                                                desc))
+        lines.append('  %-8s %9.2f' % ('total',
+                                        (time.time() - self.started) * 1000))
+
+        slowest = sorted(self.entries.items(),
+                         key=lambda x: sum(x[1].values()), reverse=True)
+        lines += ['', 'Slowest scripts (ms):', '  %9s %9s %9s %9s  %s' % (
+                  'total', 'parse', 'markup', 'render', 'file')]
+        for filepath, times in slowest[:limit]:
+            lines.append('  %9.2f %9.2f %9.2f %9.2f  %s' % (
+                sum(times.values()) * 1000, times['parse'] * 1000,
+                times['markup'] * 1000, times['render'] * 1000,
+                os.path.basename(filepath)))
+        return '\n'.join(lines)
+
+#: The active L{Timings} instance while profiling, else C{None}
+timings = None
+
+class measure(object):
+    """Context manager which adds the time taken by its body to C{phase} in
+    L{timings}. (A no-op if profiling isn't enabled)"""
+    def __init__(self, phase, filepath=None):
+        self.phase, self.filepath = phase, filepath
+
+    def __enter__(self):
+        self.start = time.time() if timings else None
+
+    def __exit__(self, *exc_info):
+        if self.start is not None and timings:
+            timings.add(self.phase, time.time() - self.start, self.filepath)
+
 class ScriptEntry(object):
     _metadata = {
         'name'        : '',
@@ -256,24 +531,39 @@ class ScriptEntry(object):
     license_re = None
     extensions = []
     anchors = []        # Static
+    cache_key = None    #: Set by L{scan_directory} to allow caching renders
+    category = ''       #: Path of the containing category, relative to root
 
     def __cmp__(self, other):
         """Make ScriptEntry objects case-insensitive sortable by name."""
         return cmp(self.metadata['name'].lower(), other.metadata['name'].lower())
 
-    def __init__(self, filename):
-        self.metadata = self._metadata.copy()
-
-        tmp = os.stat(filename)
-
-        # Store all the metadata that isn't format-specific.
-        _ = self.metadata
-        _['filepath'] = os.path.normpath(filename)
-        _['filename'] = os.path.basename(self.metadata['filepath'])
-        _['filesize'] = tmp.st_size
-        _['filetime'] = tmp.st_mtime
+    def __init__(self, filename, cache=None, contents=None, metadata=None):
+        """
+        @param contents: The file's contents, if already read.
+        @param metadata: Metadata already extracted by L{_parse}.
+            (eg. by L{scan_directory})
+        """
+        if metadata is not None:
+            self.metadata = metadata.copy()
+        else:
+            tmp = os.stat(filename)
+
+            # Reuse the parsed metadata if the file hasn't changed since it was
+            # cached. (Anchors depend on the other files present, so they
+            # aren't.)
+            cache_key = (os.path.abspath(filename), tmp.st_size, tmp.st_mtime)
+            cached = cache.get(cache_key) if cache is not None else None
+            if cached is not None:
+                self.metadata = cached[1].copy()
+            else:
+                self._parse(filename, tmp, contents)
+                if cache is not None:
+                    cache.put(cache_key, (self.__class__.__name__,
+                                          self.metadata.copy()))
 
         # Construct a hyperlinkable anchor from the filename
+        _ = self.metadata
         _['anchor'] = bad_anchor_char_re.sub('_', _['filename']).lower()
         if not _['anchor'][0].isalpha():
             _['anchor'] = 'a' + _['anchor']
@@ -286,46 +576,65 @@ class ScriptEntry(object):
             _['anchor'] = '%s%d' % (_['anchor'], count)
         self.anchors.append(_['anchor'])
 
+    def _parse(self, filename, tmp, contents=None):
+        """Extract and pretty-print all of the metadata for the given file.
+
+        (Everything done here gets cached, so it should depend only on the
+        file's contents)"""
+        self.metadata = self._metadata.copy()
+
+        # Store all the metadata that isn't format-specific.
+        _ = self.metadata
+        _['filepath'] = os.path.normpath(filename)
+        _['filename'] = os.path.basename(self.metadata['filepath'])
+        _['filesize'] = tmp.st_size
+        _['filetime'] = tmp.st_mtime
+
         # Make sure that the filename will be used as a fallback program name.
         _['name'] = _['filename']
 
         # Actually extract the metadata.
-        self._do_init()
+        with measure('parse', _['filepath']):
+            self._do_init(contents)
 
-        # Allow controlled truncation of module docstrings.
-        for marker in ('--snip--', '--clip--'):
-            if '\n%s\n' % marker in _['description']:
-                _['description'] = _['description'].split('\n%s\n' % marker, 1)[0] + '\n[...]'
+        with measure('markup', _['filepath']):
+            # Allow controlled truncation of module docstrings.
+            for marker in ('--snip--', '--clip--'):
+                if '\n%s\n' % marker in _['description']:
+                    _['description'] = _['description'].split('\n%s\n' % marker, 1)[0] + '\n[...]'
 
-        # Add various pretty-printed and escaped values to the metadata dict.
-        _.update({
-            'fname_q': urllib.quote_plus(self.metadata['filename']),
-            'fsize_p': formatFileSize(self.metadata['filesize']),
-            'desc_e': xml_escape(self.metadata['description']),
-            'mtime': time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(self.metadata['filetime']))
-        })
+            # Add various pretty-printed and escaped values to the metadata dict.
+            _.update({
+                'fname_q': urllib.quote_plus(self.metadata['filename']),
+                'fsize_p': formatFileSize(self.metadata['filesize']),
+                'desc_e': xml_escape(self.metadata['description']),
+                'mtime': time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(self.metadata['filetime']))
+            })
 
-        # Hyperlink all the URLs in the description.
-        _['desc_e'] = hyperlinkable_url_re.sub(r'<a href="\1">\1</a>', _['desc_e'])
+            # Hyperlink URLs and spam-protect e-mail addresses.
+            _['desc_e'] = markup_description(_['desc_e'])
 
-        # Add some spam protection to any e-mail addresses
-        _['desc_e'] = email_address_re.sub(spamProtectEmail, _['desc_e'])
+            # Hyperlink any licenses we can.
+            _['license_h'] = hyperlink_license(_['license'])
 
-        # Hyperlink any licenses we can.
-        _['license_h'] = _['license']
-        for regex in LICENSES:
-            if regex.search(_['license']):
-                _['license_h'] = regex.sub(r'<a href="%s">\2</a>' % LICENSES[regex], _['license'])
+    def _do_init(self, contents=None):
+        """Code to actually extract format-specific metadata goes here.
 
-    def _do_init(self):
-        """Code to actually extract format-specific metadata goes here."""
+        @param contents: The file's contents or C{None} to read it from disk.
+        """
         raise NotImplementedError("Cannot instantiate abstract class")
 
     def render(self, offline=False):
         if offline:
+            # Offline category pages live in subdirectories of the root
             self.metadata['get_url'] = self.metadata['filename']
+            self.metadata['icon_url'] = posixpath.relpath('flattr_icon.png',
+                                                          self.category or '.')
         else:
-            self.metadata['get_url'] = '?get=' + self.metadata['fname_q']
+            self.metadata['get_url'] = '?get=' + (urllib.quote_plus(
+                posixpath.join(self.category, self.metadata['filename']))
+                if self.category else self.metadata['fname_q'])
+            self.metadata['icon_url'] = 'flattr_icon.png'
 
         output = '<div class="entry"><h2 id="%(anchor)s"><a ' % self.metadata
 
@@ -334,7 +643,7 @@ class ScriptEntry(object):
 
         output += """href='%(get_url)s'>%(name)s</a>
             <a href="http://flattr.com/thing/414861/Stephan-Sokolow"
-            style="vertical-align: middle"><img src="flattr_icon.png"
+            style="vertical-align: middle"><img src="%(icon_url)s"
             alt="Flattr this" title="Flattr this" border="0" /></a>
             </h2>
             <ul class="attr_list">
@@ -360,12 +669,18 @@ class PythonScriptEntry(ScriptEntry):
             'version': re.compile(_variable_re % '__version__', re.MULTILINE)
     }
 
-    def _do_init(self):
+    #: PEP 263 encoding declaration (only valid on the first two lines)
+    _coding_re = re.compile(r"^[ \t\f]*#.*?coding[:=][ \t]*([-\w.]+)", re.M)
+
+    def _do_init(self, contents=None):
         _ = self.metadata
         _['language'] = 'Python'
 
         # Load the file and extract all metadata but the description.
-        filecontents = open(_['filepath'], 'rU').read()
+        if contents is None:
+            filecontents = open(_['filepath'], 'rU').read()
+        else:  # Match the 'rU' above
+            filecontents = contents.replace('\r\n', '\n').replace('\r', '\n')
         for key in self._metadata_regexes:
             match_obj = self._metadata_regexes[key].search(filecontents)
             if match_obj:
@@ -377,19 +692,51 @@ class PythonScriptEntry(ScriptEntry):
         except:
             _['description'] = "ERROR: Unable to parse file."
 
-    def _get_docstring(self, tup):
+    def _get_docstring(self, source):
         """
         Module docstring extractor.
+
+        Returns the first string literal in the file (quotes included),
+        tokenizing only as far as needed to find it. Falls back to
+        L{_get_docstring_parser} for anything the tokenizer chokes on.
+        """
+        try:
+            for tok in tokenize.generate_tokens(StringIO(source).readline):
+                if tok[0] == token.STRING:
+                    # Match the parser module, which recodes to UTF-8 for
+                    # anything but UTF-8 and Latin-1 declarations.
+                    match_obj = self._coding_re.search(source, 0,
+                        source.find('\n', source.find('\n') + 1) % (len(source) + 1))
+                    if match_obj:
+                        coding = match_obj.group(1)[:12].lower().replace('_', '-')
+                        if not any(coding == x or coding.startswith(x + '-') for x in
+                                   ('utf-8', 'latin-1', 'iso-8859-1', 'iso-latin-1')):
+                            return tok[1].decode(coding).encode('utf-8')
+                    return tok[1]
+                elif tok[0] == token.ERRORTOKEN:
+                    break
+            else:
+                return None
+        except (tokenize.TokenError, IndentationError, LookupError,
+                UnicodeError):
+            pass
+        return self._get_docstring_parser(source)
+
+    def _get_docstring_parser(self, tup):
+        """
+        Module docstring extractor using a full parse tree.
         Written because Demo/parser/example.py DOESN'T WORK.
         """
         if isinstance(tup, basestring):
+            if parser is None:
+                raise SyntaxError("Unable to tokenize file")
             tup = parser.suite(tup).totuple()
 
         if tup[0] == token.STRING:
             return tup[1]
         for value in tup:
             if isinstance(value, tuple):
-                val = self._get_docstring(value)
+                val = self._get_docstring_parser(value)
                 if val:
                     return val
 
@@ -399,13 +746,16 @@ class ShellScriptEntry(ScriptEntry):
 
     _license_re = re.compile(r"""^#\s*(Licensed|Released) under (the|a) (?P<license>.+?)(\slicense)?\.?\s*$""", re.M | re.I)
 
-    def _do_init(self):
+    def _do_init(self, contents=None):
         _ = self.metadata
         _['language'] = 'Bourne Shell Script'
 
         # Extract the comment block header as the description if present
+        if contents is None:
+            contents = file(_['filepath']).read()
+
         lines = []
-        for line in file(_['filepath']):
+        for line in contents.splitlines():
             line = line.strip()
             if line.startswith('#'):
                 lines.append(line)
@@ -419,6 +769,645 @@ class ShellScriptEntry(ScriptEntry):
             self.metadata['license'] = match_obj.group('license')
 
 entryClasses = [PythonScriptEntry, ShellScriptEntry]
+entryClassesByName = dict((x.__name__, x) for x in entryClasses)
+
+def _iter_files(path):
+    """Yield C{(name, stat_result)} for each regular file in C{path},
+    calling stat() only once per directory entry."""
+    if scandir is not None:
+        for dirent in scandir(path):
+            try:
+                if dirent.is_file():
+                    yield dirent.name, dirent.stat()
+            except OSError:
+                pass  # Deleted or broken symlink
+        return
+
+    for name in os.listdir(path):
+        try:
+            tmp = os.stat(os.path.join(path, name))
+        except OSError:
+            continue
+        if stat.S_ISREG(tmp.st_mode):
+            yield name, tmp
+
+def iter_categories(path):
+    """Yield the names of the subdirectories of C{path} which should be
+    listed as categories. (Hidden and C{_}-prefixed ones are skipped)"""
+    if scandir is not None:
+        names = [x.name for x in scandir(path) if x.is_dir()]
+    else:
+        names = [x for x in os.listdir(path)
+                 if os.path.isdir(os.path.join(path, x))]
+
+    for name in sorted(names, key=str.lower):
+        if not name.startswith(('.', '_')):
+            yield name
+
+def classify(fpath):
+    """Open C{fpath} once to determine which L{entryClasses} member (if any)
+    handles it.
+
+    @returns: C{(entry_class, contents)}, with C{contents} only read past the
+        first L{HEAD_SIZE} bytes if the file turned out to be a script.
+    """
+    ext = os.path.splitext(fpath)[1]
+    try:
+        with open(fpath, 'rb') as fh:
+            head = fh.read(HEAD_SIZE)
+            lineOne = head[:head.find('\n') + 1] if '\n' in head else head
+
+            for ec in entryClasses:
+                if ext in ec.extensions or ec.shabang_re.match(lineOne):
+                    if len(head) == HEAD_SIZE:
+                        head += fh.read()
+                    return ec, head
+    except IOError:
+        pass
+    return None, None
+
+def _extract_metadata(job):
+    """Parse a single file's metadata. (Top-level so L{multiprocessing} can
+    pickle it.)"""
+    class_name, fpath, contents, tmp = job
+    entry = entryClassesByName[class_name].__new__(entryClassesByName[class_name])
+    entry._parse(fpath, tmp, contents)
+    return entry.metadata
+
+def scan_directory(path, cache, processes=None):
+    """Find all the scripts in C{path} and return a list of L{ScriptEntry}
+    objects for them.
+
+    Each file gets a single stat() and, only if its cached metadata is stale,
+    a single read. If at least L{PARALLEL_THRESHOLD} files need parsing, the
+    work is spread over a pool of C{processes} processes.
+    (Defaults to one per CPU)
+    """
+    # Anchors are de-duplicated per page, so forget the last page's
+    del ScriptEntry.anchors[:]
+    cache.scanned.add(path)
+
+    found, pending = [], []
+    with measure('scan'):
+        for name, tmp in sorted(_iter_files(path)):
+            fpath = os.path.join(path, name)
+            key = (fpath, tmp.st_size, tmp.st_mtime)
+
+            cached = cache.get(key)
+            if cached is None:
+                ec, contents = classify(fpath)
+                if ec is None:
+                    cache.put(key, (None, None))  # Remember non-scripts too
+                else:
+                    pending.append((key, (ec.__name__, fpath, contents, tmp)))
+            elif cached[0]:
+                found.append((cached[0], fpath, cached[1], key))
+
+    # (Parse serially when profiling since other processes can't record
+    # into our L{timings})
+    jobs = [job for _, job in pending]
+    if len(jobs) >= PARALLEL_THRESHOLD and timings is None:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_extract_metadata, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_extract_metadata(job) for job in jobs]
+
+    for (key, job), metadata in zip(pending, results):
+        cache.put(key, (job[0], metadata))
+        found.append((job[0], job[1], metadata, key))
+
+    # Anchors are de-duplicated in creation order, so make that depend only
+    # on the directory's contents rather than on what was already cached.
+    found.sort(key=lambda x: x[1])
+
+    entries = []
+    for class_name, fpath, metadata, key in found:
+        entry = entryClassesByName[class_name](fpath, metadata=metadata)
+        entry.cache_key = key
+        entries.append(entry)
+    return entries
+
+def _code_signature():
+    """Identify this version of the script so caches are invalidated when the
+    parsing or rendering code changes."""
+    try:
+        return __version__, os.stat(os.path.abspath(__file__)).st_mtime
+    except (NameError, OSError):
+        return __version__, None
+
+def _load_pickle(path, default=None):
+    """Load a pickled cache file, returning C{default} if it's unusable, was
+    written by a different version of this script, or isn't ours.
+
+    (Unpickling someone else's file would let them run code as us.)"""
+    if path:
+        try:
+            with open(path, 'rb') as fh:
+                if os.fstat(fh.fileno()).st_uid != os.getuid():
+                    return default
+                signature, obj = cPickle.load(fh)
+            if signature == _code_signature():
+                return obj
+        except Exception:  # Missing, corrupt, or from an older version
+            pass
+    return default
+
+def _save_pickle(path, obj):
+    """Atomically pickle C{obj} to C{path}.
+
+    Failure is silently ignored since caching is only an optimization."""
+    if not path:
+        return
+
+    tmp_path = None
+    try:
+        cache_dir = os.path.dirname(path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0o700)
+        fd, tmp_path = tempfile.mkstemp(prefix='.', dir=cache_dir)
+        with os.fdopen(fd, 'wb') as fh:
+            cPickle.dump((_code_signature(), obj), fh,
+                         cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+    except (IOError, OSError, cPickle.PicklingError):
+        if tmp_path and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+class MetadataCache(object):
+    """A persistent store for L{ScriptEntry} metadata keyed by
+    C{(path, size, mtime)} so unchanged scripts don't need to be re-parsed.
+
+    Keys must start with the file's path. For each directory that was
+    scanned (see L{scan_directory}), only entries which were looked up or
+    added since loading are saved, so records for deleted or modified files
+    get pruned automatically. (Each call to L{save} starts a new generation,
+    so a long-lived instance can be reused for many runs.)
+    """
+    def __init__(self, path=CACHE_FILE):
+        self.path, self.dirty = path, False
+        self.entries, self.used = _load_pickle(path, {}), {}
+        self.scanned = set()
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.used[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = self.used[key] = value
+        self.dirty = True
+
+    def save(self):
+        """Write the cache back to disk if it's changed."""
+        # Keep records for categories which weren't viewed this time
+        for key, value in self.entries.iteritems():
+            if os.path.dirname(key[0]) not in self.scanned:
+                self.used.setdefault(key, value)
+
+        if self.dirty or len(self.used) != len(self.entries):
+            _save_pickle(self.path, self.used)
+        self.entries, self.used, self.dirty = self.used, {}, False
+        self.scanned = set()
+
+def get_validators(path='.', extra=()):
+    """Return an C{(etag, last_modified)} pair for the listing of C{path}.
+
+    The ETag covers the name, size, and mtime of every file in the directory
+    (this script included) so it changes whenever the page might. The
+    directory's own mtime is factored into C{last_modified} so deletions
+    count too.
+
+    @param extra: Anything else (eg. the page number) which the ETag should
+        distinguish between.
+    """
+    path = os.path.abspath(path)
+    state, last_modified = [], os.stat(path).st_mtime
+    for name in sorted(os.listdir(path)):
+        try:
+            tmp = os.stat(os.path.join(path, name))
+        except OSError:
+            continue  # Deleted between listdir() and stat()
+        state.append((name, tmp.st_size, tmp.st_mtime))
+        last_modified = max(last_modified, tmp.st_mtime)
+
+    etag = '"%s"' % hashlib.sha1(repr((path, _code_signature(), state,
+                                       extra))).hexdigest()
+    return etag, int(last_modified)
+
+def gzip_etag(etag):
+    """Return the variant of a strong ETag used for the gzipped body.
+
+    (The encoded bytes differ, so they mustn't share a strong validator.)"""
+    return etag[:-1] + '-gz"'
+
+def is_not_modified(environ, etag, last_modified):
+    """Check a request's conditional headers against our validators.
+
+    Either the plain or the L{gzip_etag} form of C{etag} counts as a match.
+    """
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since (RFC 7232)
+        tags = [x.strip() for x in if_none_match.split(',')]
+        return (if_none_match.strip() == '*' or
+                etag in tags or gzip_etag(etag) in tags)
+
+    if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since:
+        parsed = email.utils.parsedate_tz(if_modified_since)
+        if parsed:
+            return last_modified <= email.utils.mktime_tz(parsed)
+    return False
+
+def accepts_gzip(environ=os.environ):
+    """Check whether the client will accept a gzip-compressed response."""
+    for coding in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = [x.strip() for x in coding.split(';')]
+        if params[0].lower() in ('gzip', 'x-gzip'):
+            for param in params[1:]:
+                if param.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                    return False
+            return True
+    return False
+
+def parse_range(header, size):
+    """Parse a C{Range} header for a file of C{size} bytes.
+
+    Only a single byte range is supported. (Multipart responses aren't worth
+    the complexity for a script listing)
+
+    @returns: An inclusive C{(first, last)} pair, C{None} if the header is
+        absent or unsupported (so the whole file should be sent), or C{False}
+        if the range can't be satisfied.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+
+    if size == 0:
+        return False  # No byte range of an empty file can be satisfied
+
+    first, _, last = header[6:].strip().partition('-')
+    try:
+        if not first:             # Suffix range (the last N bytes)
+            length = int(last)
+            if length <= 0:
+                return False
+            return max(size - length, 0), size - 1
+
+        first = int(first)
+        last = int(last) if last else size - 1
+    except ValueError:
+        return None
+
+    if first >= size:
+        return False
+    if last < first:
+        return None
+    return first, min(last, size - 1)
+
+def iter_file(fh, offset=0, length=None, chunk_size=FILE_CHUNK_SIZE):
+    """Yield C{length} bytes (or the rest) of C{fh} from C{offset} in chunks,
+    closing it when done."""
+    try:
+        fh.seek(offset)
+        while length is None or length > 0:
+            data = fh.read(chunk_size if length is None
+                           else min(chunk_size, length))
+            if not data:
+                break
+            if length is not None:
+                length -= len(data)
+            yield data
+    finally:
+        fh.close()
+
+def encode_body(chunks, use_gzip=False):
+    """Join chunks of the page with newlines (to match L{list_content}) and
+    yield them as they become available, gzip-compressing if requested.
+
+    Each chunk is flushed through the compressor so the browser can start
+    rendering before the whole page is ready."""
+    compressor = use_gzip and zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    sep = ''
+    for chunk in chunks:
+        data = sep + chunk
+        if compressor:
+            data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield data
+        sep = '\n'
+
+    if compressor:
+        yield compressor.compress('\n') + compressor.flush()
+    else:
+        yield '\n'
+
+#: Held while generating a page or using any of the state shared between
+#: requests (L{ScriptEntry.anchors}, L{MetadataCache}, L{ListingApp.hot},
+#: and L{timings}). Re-entrant since generation happens inside the others.
+#: (Never held across a C{yield}, since a slow client would then block every
+#: other request until it finished downloading. See L{ListingApp._get_page})
+generation_lock = threading.RLock()
+
+class ListingApp(object):
+    """WSGI application serving the listing for a directory and, via
+    C{?get=<filename>}, the raw scripts in it.
+
+    Subdirectories are served as categories via C{?cat=<path>} and, if
+    C{page_size} is set, long listings are split into pages via
+    C{?page=<number>}.
+
+    Used for both CGI (via C{wsgiref.handlers.CGIHandler}) and persistent
+    servers. In the latter case, the metadata cache and the rendered pages
+    stay in memory between requests and are revalidated by checking the
+    directory's mtime (plus a full L{get_validators} sweep every
+    L{HOT_CACHE_TTL} seconds).
+
+    Multithreaded servers (eg. mod_wsgi) are fine, but pages are generated
+    one at a time since that touches shared state. (See L{generation_lock})
+    """
+    def __init__(self, path=None, page_size=PAGE_SIZE, profile=PROFILE):
+        self.path = os.path.abspath(path or os.path.dirname(
+            os.path.abspath(__file__)))
+        self.page_size, self.profile = page_size, profile
+        self.hot = {}       # {(category, page): (dir mtime, checked at,
+                            #                     etag, last_modified, page)}
+        self.page_counts = {}  # {category: (dir mtime, checked at, etag,
+                               #             number of pages)}
+        self._cache = None  # Loaded lazily so importing this stays cheap
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = MetadataCache()
+        return self._cache
+
+    def __call__(self, environ, start_response):
+        if self.profile:
+            return self._call_profiled(environ, start_response)
+        return self._dispatch(environ, start_response)
+
+    def _call_profiled(self, environ, start_response):
+        """Buffer the response so a C{Server-Timing} header can be added."""
+        global timings
+        response = []
+        with generation_lock:
+            timings = Timings()
+            try:
+                body = ''.join(self._dispatch(environ,
+                    lambda status, headers: response.extend((status, headers))))
+                headers = response[1] + [('Server-Timing',
+                                          timings.server_timing())]
+            finally:
+                timings = None
+
+        start_response(response[0], headers)
+        return [body]
+
+    def _dispatch(self, environ, start_response):
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        if 'get' in query:
+            return self.serve_file(environ, start_response, query['get'][0])
+
+        category = self._get_category(query.get('cat', [''])[0])
+        if category is None:
+            return self.serve_error(start_response, "Unfortunately, you have "
+                "requested an invalid category. Please <a href='?'>try "
+                "again</a>.")
+        if 'search' in query:
+            return self.serve_listing(environ, start_response, category,
+                                      'search')
+
+        try:
+            page = max(int(query.get('page', ['1'])[0]), 1)
+        except ValueError:
+            page = 1
+        if not self.page_size:
+            page = 1
+        return self.serve_listing(environ, start_response, category, page)
+
+    def _get_category(self, category):
+        """Normalize a requested category, returning C{None} if it isn't one
+        of the subdirectories we list."""
+        category = posixpath.normpath('/' + category).strip('/')
+        if not category:
+            return ''
+        if any(x.startswith(('.', '_')) for x in category.split('/')):
+            return None
+        if not os.path.isdir(os.path.join(self.path, category)):
+            return None
+        return category
+
+    def _get_page(self, category='', page=1, stream=False):
+        """Return C{(etag, last_modified, chunks)} for the requested listing
+        (or, if C{page} is C{'search'}, its search index), reusing the
+        in-memory or on-disk copy if it's still valid.
+
+        If C{stream} is set, a page which has to be generated is returned as
+        a generator so it can be sent while it's still being built. That
+        happens outside of L{generation_lock}, so it's only safe when no other
+        request can run concurrently. (ie. CGI and single-threaded servers)
+        """
+        with generation_lock:
+            etag, last_modified, chunks = self._get_page_locked(category, page)
+            if not stream:
+                chunks = list(chunks)
+        return etag, last_modified, chunks
+
+    def _page_cache_path(self, category=None, page=None):
+        """Return the file the given page is cached in, the directory for all
+        of C{category}'s pages, or (with no arguments) the directory for all
+        categories."""
+        if not PAGE_CACHE_DIR:
+            return None
+        path = os.path.join(PAGE_CACHE_DIR, hashlib.sha1(self.path).hexdigest())
+        if category is not None:
+            # (Listed categories can't start with "_", so this can't clash)
+            path = os.path.join(path, urllib.quote(category, safe='') or '_root')
+        if page is not None:
+            path = os.path.join(path, '%s.page' % page)
+        return path
+
+    def _prune_pages(self, category, pages=None):
+        """Forget the cached pages of C{category} past C{pages} or, if C{pages}
+        is C{None} (because the directory is gone), all of them."""
+        for key in list(self.hot):
+            if key[0] == category and (pages is None or
+                    (key[1] != 'search' and key[1] > pages)):
+                del self.hot[key]
+
+        cache_dir = self._page_cache_path(category)
+        if not cache_dir or not os.path.isdir(cache_dir):
+            return
+        for name in os.listdir(cache_dir):
+            page = name.split('.')[0]
+            if pages is None or (page.isdigit() and int(page) > pages):
+                try:
+                    os.remove(os.path.join(cache_dir, name))
+                except OSError:
+                    pass
+        if pages is None:
+            try:
+                os.rmdir(cache_dir)
+            except OSError:
+                pass
+
+    def _prune_vanished(self):
+        """Forget the cached pages of categories which no longer exist."""
+        categories = set(key[0] for key in self.hot)
+        cache_dir = self._page_cache_path()
+        if cache_dir and os.path.isdir(cache_dir):
+            categories.update(urllib.unquote(x) for x in os.listdir(cache_dir)
+                              if x != '_root')
+        for category in categories:
+            if category and not os.path.isdir(
+                    os.path.join(self.path, category)):
+                self._prune_pages(category)
+                self.page_counts.pop(category, None)
+
+    def _clamp_page(self, dir_path, category, page):
+        """Clamp C{page} to the pages C{category} actually has, so made-up
+        page numbers can't fill up the caches."""
+        if page == 1 or page == 'search' or not self.page_size:
+            return page
+
+        now, dir_mtime = time.time(), os.stat(dir_path).st_mtime
+        known = self.page_counts.get(category)
+        if not (known and known[0] == dir_mtime and
+                now - known[1] < HOT_CACHE_TTL):
+            etag = get_validators(dir_path)[0]
+            if not known or known[2] != etag:
+                count = len(scan_directory(dir_path, self.cache))
+                pages = max((count + self.page_size - 1) // self.page_size, 1)
+                self._prune_pages(category, pages)
+            else:
+                pages = known[3]
+            known = self.page_counts[category] = (dir_mtime, now, etag, pages)
+        return min(page, known[3])
+
+    def _get_page_locked(self, category, page):
+        dir_path = os.path.join(self.path, category) if category else self.path
+        page = self._clamp_page(dir_path, category, page)
+        hot_key = (category, page)
+        hot = self.hot.get(hot_key)
+
+        now, dir_mtime = time.time(), os.stat(dir_path).st_mtime
+        if hot and hot[0] == dir_mtime and now - hot[1] < HOT_CACHE_TTL:
+            return hot[2], hot[3], [hot[4]]
+
+        etag, last_modified = get_validators(dir_path, (page, self.page_size))
+        if hot and hot[2] == etag:
+            self.hot[hot_key] = (dir_mtime, now) + hot[2:]
+            return etag, last_modified, [hot[4]]
+
+        cache_path = self._page_cache_path(category, page)
+        cached_etag, content = _load_pickle(cache_path, (None, None))
+        if cached_etag == etag:
+            self.hot[hot_key] = (dir_mtime, now, etag, last_modified, content)
+            return etag, last_modified, [content]
+
+        def generate():
+            """Yield the page while it's being generated, then cache it."""
+            chunks = []
+            if page == 'search':
+                source = [search_index(self.path, self.cache, category,
+                                       self.page_size)]
+            else:
+                source = iter_content(self.path, cache=self.cache,
+                    category=category, page=page, page_size=self.page_size)
+            for chunk in source:
+                chunks.append(chunk)
+                yield chunk
+
+            content = '\n'.join(chunks)
+            self.hot[hot_key] = (dir_mtime, now, etag, last_modified, content)
+            _save_pickle(cache_path, (etag, content))
+            self._prune_vanished()
+        return etag, last_modified, generate()
+
+    def serve_error(self, start_response, message):
+        """Serve a 404 Not Found page with the given HTML message."""
+        start_response('404 Not Found',
+                       [('Content-Type', 'text/html; charset=utf-8')])
+        return [PAGE_HEADER, "<p>%s</p>" % message, page_footer()]
+
+    def serve_listing(self, environ, start_response, category='', page=1):
+        """Serve the listing, or just a 304 Not Modified when the client's
+        copy is still current."""
+        etag, last_modified, chunks = self._get_page(category, page,
+            stream=not environ.get('wsgi.multithread', True))
+        use_gzip = accepts_gzip(environ)
+        headers = [('ETag', gzip_etag(etag) if use_gzip else etag),
+                   ('Last-Modified',
+                    email.utils.formatdate(last_modified, usegmt=True))]
+
+        if is_not_modified(environ, etag, last_modified):
+            start_response('304 Not Modified', headers)
+            return []
+
+        headers += [('Content-Type', 'application/json' if page == 'search'
+                     else 'text/html; charset=utf-8'),
+                    ('Vary', 'Accept-Encoding')]
+        if use_gzip:
+            headers.append(('Content-Encoding', 'gzip'))
+
+        start_response('200 OK', headers)
+        return encode_body(chunks, use_gzip)
+
+    def serve_file(self, environ, start_response, name):
+        """Serve one of the listed files as plain text."""
+        fname = os.path.normpath(os.path.join(self.path, name))
+        if not fname.startswith(self.path + os.sep) or not os.path.isfile(fname):
+            return self.serve_error(start_response, "Unfortunately, you have "
+                "requested an invalid file. Please <a href='?'>try again</a>.")
+
+        fh = open(fname, 'rb')
+        tmp = os.fstat(fh.fileno())
+        size, last_modified = tmp.st_size, int(tmp.st_mtime)
+        etag = '"%x-%x"' % (size, int(tmp.st_mtime * 1000000))
+        headers = [('ETag', etag), ('Accept-Ranges', 'bytes'),
+                   ('Last-Modified',
+                    email.utils.formatdate(last_modified, usegmt=True))]
+
+        if is_not_modified(environ, etag, last_modified):
+            fh.close()
+            start_response('304 Not Modified', headers)
+            return []
+
+        headers.append(('Content-Type', 'text/plain'))
+
+        # Only honour Range if If-Range (when given) still matches
+        byte_range = None
+        if_range = environ.get('HTTP_IF_RANGE', '').strip()
+        if not if_range or if_range == etag:
+            byte_range = parse_range(environ.get('HTTP_RANGE'), size)
+
+        if byte_range is False:
+            fh.close()
+            start_response('416 Requested Range Not Satisfiable',
+                headers + [('Content-Range', 'bytes */%d' % size),
+                           ('Content-Length', '0')])
+            return []
+        elif byte_range:
+            first, last = byte_range
+            start_response('206 Partial Content', headers + [
+                ('Content-Range', 'bytes %d-%d/%d' % (first, last, size)),
+                ('Content-Length', str(last - first + 1))])
+            return iter_file(fh, first, last - first + 1)
+
+        start_response('200 OK', headers + [('Content-Length', str(size))])
+        if 'wsgi.file_wrapper' in environ:
+            return environ['wsgi.file_wrapper'](fh, FILE_CHUNK_SIZE)
+        return iter_file(fh)
+
+#: Entry point for WSGI servers (eg. mod_wsgi, gunicorn, or C{--serve})
+application = ListingApp()
 
 def spamProtectEmail(match_obj):
     """Use this as the replacement in a regex substitution with
@@ -434,6 +1423,74 @@ def spamProtectEmail(match_obj):
 
     return email
 
+def _markup_token(match_obj):
+    token = match_obj.group(0)
+    if '://' in token:
+        token = hyperlinkable_url_re.sub(r'<a href="\1">\1</a>', token)
+    if '@' in token:
+        token = email_address_re.sub(spamProtectEmail, token)
+    return token
+
+def markup_description(text):
+    """Hyperlink all the URLs and spam-protect all the e-mail addresses in an
+    escaped description in a single pass.
+
+    (Addresses within URLs get spam-protected too, as they did when each
+    regex was run over the whole description in turn.)
+    """
+    return markup_token_re.sub(_markup_token, text)
+
+def _link_license(match_obj):
+    for group, url in _license_groups:
+        if match_obj.group(group) is not None:
+            return '<a href="%s">%s</a>' % (url, match_obj.group(group))
+
+def hyperlink_license(license):
+    """Hyperlink the name of any of the L{LICENSES} in C{license}."""
+    return licenses_re.sub(_link_license, license)
+
+def benchmark_markup(path='.', sizes=(1, 10, 100), rounds=5):
+    """Compare L{markup_description} and L{hyperlink_license} against running
+    each regex in turn (the old approach) on long docstrings made by joining
+    together the descriptions of the scripts in C{path}."""
+    def multi_pass(text):
+        text = hyperlinkable_url_re.sub(r'<a href="\1">\1</a>', text)
+        return email_address_re.sub(spamProtectEmail, text)
+
+    def each_license(license):
+        result = license
+        for regex in LICENSES:
+            if regex.search(license):
+                result = regex.sub(r'<a href="%s">\2</a>' % LICENSES[regex],
+                                   license)
+        return result
+
+    def best_of(func, args):
+        times = []
+        for _ in range(rounds):
+            start = time.time()
+            for arg in args:
+                func(arg)
+            times.append(time.time() - start)
+        return min(times) * 1000
+
+    entries = scan_directory(os.path.abspath(path), MetadataCache(None))
+    desc = xml_escape('\n\n'.join(x.metadata['description'] for x in entries))
+    licenses = [x.metadata['license'] for x in entries] * 100
+
+    print("%-10s %12s %16s %16s" % ('Input', 'Size (KiB)', 'Multi-pass (ms)',
+                                     'Single (ms)'))
+    for count in sizes:
+        text = '\n\n'.join([desc] * count)
+        assert multi_pass(text) == markup_description(text)
+        print("%-10s %12d %16.2f %16.2f" % ('desc x%d' % count,
+            len(text) // 1024, best_of(multi_pass, [text]),
+            best_of(markup_description, [text])))
+
+    assert map(each_license, licenses) == map(hyperlink_license, licenses)
+    print("%-10s %12d %16.2f %16.2f" % ('licenses', len(licenses),
+        best_of(each_license, licenses), best_of(hyperlink_license, licenses)))
+
 def formatFileSize(size, unit='', precision=0):
     """Take a size in bits or bytes and return it all prettied
     up and rounded to whichever unit gives the smallest number.
@@ -467,29 +1524,79 @@ def formatFileSize(size, unit='', precision=0):
 
     return '%.*f %s' % (precision, size, units[unit_idx])
 
-def list_content(path='.', offline=False):
+def list_content(path='.', offline=False, cache=None, category='',
+                 page=1, page_size=0):
     """Generate an HTML listing of available files, complete with metadata"""
-    scripts, categories, path = [], [], os.path.abspath(path)
-
-    for name in os.listdir(os.path.abspath(path)):
-        fpath = os.path.join(path, name)
-
-        if os.path.isdir(fpath):
-            pass  # TODO: Support categories.
+    return '\n'.join(iter_content(path, offline, cache, category,
+                                  page, page_size))
+
+def category_url(target, current='', offline=False, page=1):
+    """Return a link to page C{page} of the C{target} category from the page
+    for C{current}. (Categories are paths relative to the root, with C{''}
+    being the root itself.)"""
+    if offline:
+        # Each category has its own index.html, so link to the directory
+        return posixpath.relpath(target or '.', current or '.') + '/'
+
+    params = []
+    if target:
+        params.append('cat=' + urllib.quote_plus(target))
+    if page > 1:
+        params.append('page=%d' % page)
+    return '?' + '&amp;'.join(params)
+
+def _page_links(category, page, pages):
+    """Render the navigation between pages of a paginated category."""
+    links = []
+    for num in range(1, pages + 1):
+        if num == page:
+            links.append('<strong>%d</strong>' % num)
         else:
-            ext = os.path.splitext(name)[1]
-            for ec in entryClasses:
-                if ext in ec.extensions:
-                    scripts.append(ec(name))
-                    continue
-
-                lineOne = file(name).readline()
-                if ec.shabang_re.match(lineOne):
-                    scripts.append(ec(name))
+            links.append("<a href='%s'>%d</a>" % (
+                category_url(category, category, page=num), num))
+    return "<p class='pages'>Page: %s</p>" % ' '.join(links)
+
+def iter_content(path='.', offline=False, cache=None, category='',
+                 page=1, page_size=0):
+    """Generate the HTML listing of available files piece by piece so the
+    static header can be sent before any of the scripts have been parsed.
+
+    Only the requested category (subdirectory) is scanned and only the
+    requested page of it is rendered.
+
+    @param cache: A L{MetadataCache} to use instead of loading one from disk.
+    @param category: The subdirectory of C{path} to list, if any.
+    @param page_size: How many scripts to show per page. (0 for all)
+    """
+    yield PAGE_HEADER
+
+    path = os.path.abspath(path)
+    dir_path = os.path.join(path, category) if category else path
+    categories = [posixpath.join(category, x)
+                  for x in iter_categories(dir_path)]
+    if cache is None:
+        cache = MetadataCache()
+
+    scripts = scan_directory(dir_path, cache)
     scripts.sort()
 
-    output = [PAGE_HEADER]
-    output.append("<div class='menu'><h2>Table of Contents</h2><ol>")
+    pages = 1
+    if page_size and scripts:
+        pages = (len(scripts) + page_size - 1) // page_size
+        page = min(max(page, 1), pages)
+        scripts = scripts[(page - 1) * page_size:page * page_size]
+
+    if offline:
+        index_url, page_url = 'search.json', ''  # (Offline isn't paginated)
+    else:
+        index_url = category_url(category, category)
+        index_url += ('&amp;' if len(index_url) > 1 else '') + 'search=1'
+        page_url = category_url(category, category, page=2)[:-1]
+
+    output = ["<div class='menu'><h2>Table of Contents</h2>",
+              SEARCH_BOX % locals(), "<ol>"]
+    if categories:
+        output.append("<li><a href='#categories'>Categories</a></li>")
     for entry in scripts:
         tmp = '<li><a '
 
@@ -499,23 +1606,186 @@ def list_content(path='.', offline=False):
 
         tmp += "href='#%s'>%s</a></li>" % (entry.metadata['anchor'], entry.metadata['name'])
         output.append(tmp)
-    output.append("</ol><hr><a href='..' class='backlink' rel='home'>Back to Parent Site</a></div>")
+    # (Offline category pages live in subdirectories of the root)
+    parent = posixpath.relpath('..', category or '.') if offline else '..'
+    output.append("</ol><hr><a href='%s' class='backlink' rel='home'>Back to Parent Site</a></div>" % parent)
     output.append(BODY_HEADER)
 
+    if category:
+        crumbs, parts = [], category.split('/')
+        for idx, part in enumerate(parts[:-1]):
+            crumbs.append("<a href='%s'>%s</a>" % (category_url(
+                '/'.join(parts[:idx + 1]), category, offline), xml_escape(part)))
+        crumbs.append('<strong>%s</strong>' % xml_escape(parts[-1]))
+        output.append("<p class='breadcrumbs'><a href='%s'>Index</a> / %s</p>"
+            % (category_url('', category, offline), ' / '.join(crumbs)))
     if categories:
-        output.append("<h2>Categories</h2>")  # TODO: Add this to the table of contents.
+        output.append("<h2 id='categories'>Categories</h2><ul class='categories'>")
+        for target in categories:
+            output.append("<li><a href='%s'>%s</a></li>" % (category_url(
+                target, category, offline), xml_escape(posixpath.basename(target))))
+        output.append("</ul>")
+    if pages > 1:
+        output.append(_page_links(category, page, pages))
+    yield '\n'.join(output)
 
     for entry in scripts:
-        output.append(entry.render(offline=offline))
-    output.append(PAGE_FOOTER)
+        entry.category = category
+        yield render_entry(entry, cache, offline)
+    if pages > 1:
+        yield _page_links(category, page, pages)
+    yield SEARCH_SCRIPT
+    yield page_footer()
+    cache.save()
+
+def render_entry(entry, cache, offline=False):
+    """Render an entry, reusing its cached HTML if it and its anchor are
+    unchanged since the last run."""
+    with measure('render', entry.metadata['filepath']):
+        if entry.cache_key is None:
+            return entry.render(offline=offline)
+
+        key = entry.cache_key + ('render', entry.category,
+                                 entry.metadata['anchor'], offline)
+        output = cache.get(key)
+        if output is None:
+            output = entry.render(offline=offline)
+            cache.put(key, output)
+        return output
 
-    return '\n'.join(output)
+_search_term_re = re.compile(r'[a-z0-9]+')  # Must match SEARCH_SCRIPT
+
+def entry_terms(entry, cache=None):
+    """Return the sorted search terms for an entry, reusing the cached list
+    if the file is unchanged since the last run."""
+    key = entry.cache_key and entry.cache_key + ('terms',)
+    terms = key and cache and cache.get(key)
+    if terms is None:
+        _ = entry.metadata
+        text = ' '.join(unicode(x, 'utf-8', 'replace') if isinstance(x, str)
+                        else unicode(x) for x in (_['name'], _['filename'],
+                        _['description'], _['license'], _['language']))
+        terms = sorted(set(_search_term_re.findall(text.lower())))
+        if key and cache:
+            cache.put(key, terms)
+    return terms
+
+def build_search_index(entries, cache=None, page_size=0):
+    """Build a compact JSON inverted index over the given (sorted) entries.
+
+    The result looks like C{{"docs": [[anchor, name, page], ...],
+    "terms": {term: [doc, ...], ...}}} where each C{doc} is an index into
+    C{docs} and C{page} is the page the entry appears on.
+    """
+    docs, terms = [], {}
+    for idx, entry in enumerate(entries):
+        docs.append([entry.metadata['anchor'],
+                     xml_escape(unicode(entry.metadata['name'], 'utf-8',
+                                        'replace')),
+                     idx // page_size + 1 if page_size else 1])
+        for term in entry_terms(entry, cache):
+            terms.setdefault(term, []).append(idx)
+    return json.dumps({'docs': docs, 'terms': terms},
+                      separators=(',', ':'), sort_keys=True)
+
+def search_index(path='.', cache=None, category='', page_size=0):
+    """Return the JSON search index for the listing of C{category}."""
+    path = os.path.abspath(path)
+    if cache is None:
+        cache = MetadataCache()
+
+    scripts = scan_directory(os.path.join(path, category) if category
+                             else path, cache)
+    scripts.sort()
+    result = build_search_index(scripts, cache, page_size)
+    cache.save()
+    return result
+
+_generated_re = re.compile(r'This page generated at [^<]*')
+
+def write_if_changed(path, data, ignore_re=None):
+    """Write C{data} to C{path} unless it's already there.
+
+    @param ignore_re: A regex matching parts of the content (eg. timestamps)
+        which shouldn't count as a change on their own.
+    @returns: C{True} if the file was written.
+    """
+    try:
+        with open(path, 'rb') as fh:
+            old = fh.read()
+    except IOError:
+        old = None
+
+    if old is not None:
+        if old == data or (ignore_re and
+                ignore_re.sub('', old) == ignore_re.sub('', data)):
+            return False
+
+    with open(path, 'wb') as fh:
+        fh.write(data)
+    return True
+
+def gzip_compress(data):
+    """Compress C{data} at maximum level with a reproducible gzip header."""
+    buf = StringIO()
+    with gzip.GzipFile(filename='', mode='wb', compresslevel=9,
+                       fileobj=buf, mtime=0) as fh:
+        fh.write(data)
+    return buf.getvalue()
+
+def build_offline(path='.'):
+    """Generate a static C{index.html} and C{search.json} (plus precompressed
+    copies) in C{path} and each of its categories, plus an C{.htaccess} in
+    C{path}, only touching files whose content has changed.
+    """
+    path, cache = os.path.abspath(path), MetadataCache()
+
+    compressed = [('.gz', gzip_compress)]
+    if brotli is not None:
+        compressed.append(('.br', lambda data: brotli.compress(data,
+                                                               quality=11)))
+
+    categories = ['']
+    while categories:
+        category = categories.pop(0)
+        dir_path = os.path.join(path, category)
+        categories.extend(posixpath.join(category, x)
+                          for x in iter_categories(dir_path))
+
+        # Ignore the timestamp in the footer or we'd rewrite every time.
+        for name, data, ignore_re in (
+                ('index.html', list_content(path, True, cache, category),
+                 _generated_re),
+                ('search.json', search_index(path, cache, category), None)):
+            out_path = os.path.join(dir_path, name)
+            changed = write_if_changed(out_path, data, ignore_re)
+            for ext, compress in compressed:
+                if changed or not os.path.exists(out_path + ext):
+                    write_if_changed(out_path + ext, compress(data))
+
+    # (Apache applies this to the subdirectories too)
+    write_if_changed(os.path.join(path, '.htaccess'), HTACCESS)
 
 if __name__ == '__main__':
     from optparse import OptionParser
     opt_parser = OptionParser(description=__doc__, version="%%prog v%s" % __version__)
     opt_parser.add_option('--offline', action="store_true", dest="offline",
         default=False, help="Generate a static index.html and .htaccess")
+    opt_parser.add_option('--serve', action="store", dest="serve", default=None,
+        metavar="[HOST:]PORT", help="Serve the current directory using a "
+        "simple local WSGI server (for testing the persistent mode)")
+    opt_parser.add_option('--benchmark', action="store_true",
+        dest="benchmark", default=False, help="Compare the speed of the "
+        "description and license markup against the old multi-pass approach "
+        "using long docstrings built from the scripts in this directory")
+    opt_parser.add_option('--profile', action="store_true", dest="profile",
+        default=False, help="Time each phase of generating the listing "
+        "(ignoring the caches) and report the slowest scripts. With --serve, "
+        "add a Server-Timing header to each response instead.")
+    opt_parser.add_option('--page-size', action="store", type="int",
+        dest="page_size", default=PAGE_SIZE, metavar="NUM", help="Split "
+        "categories into pages of NUM scripts when serving. (0 for no "
+        "pagination. Default: %default)")
 
     # Allow pre-formatted descriptions
     opt_parser.formatter.format_description = lambda description: description
@@ -523,26 +1793,18 @@ if __name__ == '__main__':
     opts, args = opt_parser.parse_args()
 
     if opts.offline:
-        with open('index.html', 'w') as fh:
-            fh.write(list_content(offline=True))
-        with open('.htaccess', 'w') as fh:
-            fh.write(HTACCESS)
+        build_offline()
+    elif opts.serve:
+        from wsgiref.simple_server import make_server
+        host, _, port = opts.serve.rpartition(':')
+        make_server(host or 'localhost', int(port), ListingApp(os.getcwd(),
+            opts.page_size, opts.profile or PROFILE)).serve_forever()
+    elif opts.benchmark:
+        benchmark_markup()
+    elif opts.profile:
+        timings = Timings()
+        list_content(cache=MetadataCache(None))
+        print(timings.report())
     else:
-        form = cgi.FieldStorage()
-        if 'get' in form:
-            print("Content-Type: text/html; charset=utf-8")
-            print('')
-            print(list_content())
-        else:
-            fname = os.path.normpath(form['get'].value)
-            if not os.path.abspath(fname).startswith(os.getcwd()) or not os.path.isfile(fname):
-                print("Content-Type: text/html; charset=utf-8")
-                print('')
-                print(PAGE_HEADER)
-                print("<p>Unfortunately, you have requested an invalid file. "
-                      "Please <a href='?'>try again</a>.</p>")
-                print(PAGE_FOOTER)
-            else:
-                print("Content-Type: text/plain")
-                print('')
-                print(file(form['get'].value).read())
+        from wsgiref.handlers import CGIHandler
+        CGIHandler().run(ListingApp(os.getcwd(), opts.page_size))
@@ -39,6 +39,9 @@ MARKER_BLOCK = "\x52\x61\x72\x21\x1a\x07\x00"
 FIND_LIMIT = 1024**2 #: 1MiB
 # A Compromise. Override FIND_LIMIT with 0 to be sure but potentially very slow.
 
+#{ Settings for iter_rarfiles()
+SCAN_WORKERS = 8 #: Probes are I/O-bound, so threads beat processes here.
+
 #{ Packing method values
 RAR_STORED = 0x30
 RAR_FASTEST = 0x31
@@ -48,7 +51,7 @@ RAR_GOOD = 0x34
 RAR_BEST = 0x35
 #}
 
-import math, struct, sys, time, zlib
+import math, os, struct, sys, time, zlib
 
 _struct_blockHeader = struct.Struct("<HBHH")
 _struct_addSize = struct.Struct('<L')
@@ -329,15 +332,91 @@ def is_rarfile(filename, limit=FIND_LIMIT):
         pass
     return False
 
+def _probe_rarfile(path, limit=FIND_LIMIT):
+    """Return a C{(path, header_offset)} tuple for a single candidate.
+
+    Plain (non-SFX) RAR files are by far the common case, so the marker is
+    checked at offset 0 with a single small read before falling back to the
+    rolling-window search in L{findRarHeader}.
+
+    C{header_offset} is C{None} for non-RAR or unreadable files.
+    """
+    try:
+        handle = open(path, 'rb')
+    except (IOError, OSError):
+        return path, None
+
+    try:
+        try:
+            if handle.read(len(MARKER_BLOCK)) == MARKER_BLOCK:
+                return path, len(MARKER_BLOCK)
+            handle.seek(0)
+            return path, findRarHeader(handle, limit)
+        except (IOError, OSError):
+            return path, None
+    finally:
+        handle.close()
+
+def _walk_paths(paths):
+    """Expand a list of files and directories into a stream of file paths."""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for fname in sorted(files):
+                    yield os.path.join(root, fname)
+        else:
+            yield path
+
+def iter_rarfiles(paths, limit=FIND_LIMIT, workers=SCAN_WORKERS):
+    """Bulk equivalent to L{is_rarfile} for classifying whole directory trees.
+
+    Walks every directory in C{paths} (plain files are probed directly) and
+    probes candidates on a pool of C{workers} threads, yielding
+    C{(path, header_offset)} tuples for each RAR file found as soon as it is
+    identified. C{header_offset} has the same meaning as the return value of
+    L{findRarHeader}.
+
+    @note: Results are yielded in completion order, not walk order.
+    """
+    from itertools import islice
+    from multiprocessing.pool import ThreadPool
+
+    walk, pool = _walk_paths(paths), ThreadPool(workers)
+    try:
+        # imap_unordered's task handler drains whatever it's given as fast as
+        # it can, so feed it the walk a few chunks per worker at a time to
+        # keep memory use bounded no matter how many files there are.
+        while True:
+            batch = list(islice(walk, workers * 64))
+            if not batch:
+                break
+            for path, offset in pool.imap_unordered(
+                    lambda path: _probe_rarfile(path, limit),
+                    batch, chunksize=16):
+                if offset is not None:
+                    yield path, offset
+    finally:
+        pool.terminate()
 
 if __name__ == '__main__':
     from optparse import OptionParser
     parser = OptionParser(description=__doc__.split('\n\n')[0],
             version="%%prog v%s" % __version__, usage="%prog <path> ...")
+    parser.add_option('-r', '--scan', action="store_true", dest="scan",
+        default=False, help="Recursively classify the given paths and print "
+        "the header offset of each RAR file found instead of listing contents")
+    parser.add_option('-j', '--jobs', action="store", type="int",
+        dest="workers", default=SCAN_WORKERS, metavar="N",
+        help="Number of files to probe concurrently with --scan "
+        "(default: %default)")
 
     opts, args = parser.parse_args()
 
-    if args:
+    if args and opts.scan:
+        for fpath, offset in iter_rarfiles(args, workers=opts.workers):
+            print "%s\t%d" % (fpath, offset)
+    elif args:
         RarFile.debug = 1
         for fpath in args:
             print "File: %s" % fpath
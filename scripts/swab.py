@@ -6,6 +6,18 @@ A script for swapping the audio-track byte order in cdrdao .BIN files so that a
 2016-03-03: Since I've been meaning to fix this since 2009 and it was
             embarassing, I rewrote it just enough that it isn't doing a syscall
             for every two bytes.
+2016-03-05: Swap whole chunks at once using array.byteswap() (or NumPy if
+            it's installed) so we're no longer doing a Python-level write for
+            every sample either.
+2016-03-06: Added an in-place mode which mmaps the .BIN and only touches the
+            audio extents. Copies now reflink the source where the filesystem
+            supports it and otherwise use copy_file_range() for data tracks.
+2016-03-07: Added --jobs to split the audio into fixed-size work units and
+            swap them on a thread pool using pread()/pwrite() at explicit
+            offsets, for when a single core can't keep up with the disk.
+2016-03-08: Accept - as the target to stream the converted image to stdout
+            (eg. into a compressor) and report its MD5, SHA1, and CRC32 on
+            stderr, computed in the same pass.
 
 TODO:
 - Rewrite in Rust and optimize.
@@ -13,10 +25,47 @@ TODO:
 
 __license__ = "GNU GPL 2.0 or newer"
 
-import locale, os, shlex, sys
+import array, ctypes, ctypes.util, errno, fcntl, hashlib, locale, mmap, os
+import shlex, sys, zlib
 locale.setlocale(locale.LC_ALL, '')
 
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
 CHUNK_SIZE = 256 * 1024
+WORK_UNIT_SIZE = 4 * 1024 * 1024  # Must be even. Used by --jobs.
+FICLONE = 0x40049409  # From linux/fs.h (_IOW(0x94, 9, int))
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+_copy_file_range = getattr(_libc, 'copy_file_range', None)
+if _copy_file_range is not None:
+	_copy_file_range.restype = ctypes.c_ssize_t
+	_copy_file_range.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+		ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t,
+		ctypes.c_uint]
+
+# Python 2 has no os.pread()/os.pwrite(). ctypes releases the GIL for the
+# duration of the call, so threads using these really do overlap their I/O.
+_libc.pread.restype = _libc.pwrite.restype = ctypes.c_ssize_t
+_libc.pread.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+	ctypes.c_int64]
+_libc.pwrite.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t,
+	ctypes.c_int64]
+
+def swab(chunk):
+	"""Swap the byte order of every 16-bit sample in a string in one go."""
+	if numpy is not None:
+		return numpy.frombuffer(chunk, dtype=numpy.uint16).byteswap().tostring()
+
+	samples = array.array('H')
+	if samples.itemsize != 2:
+		# Should never happen on any platform we care about, but be safe.
+		return ''.join(chunk[i + 1] + chunk[i] for i in range(0, len(chunk), 2))
+	samples.fromstring(chunk)
+	samples.byteswap()
+	return samples.tostring()
 
 def time_to_frames(timecode):
 	mins, secs, frames = [int(x) for x in timecode.split(':')]
@@ -62,37 +111,236 @@ def get_extents(fh):
 
 	return binfile, tracks
 
-if __name__ == '__main__':
-	if len(sys.argv) != 3:
-		print "Usage: %s <cue file> <target bin file>" % sys.argv[0]
-		sys.exit(1)
+status = sys.stdout  # Switched to stderr when streaming the image to stdout
+
+def report_progress(offset):
+	status.write('\rProcessing offset %s' %
+		locale.format('%d', offset, grouping=True))
+
+def reflink(infile, outfile):
+	"""Try to make outfile a copy-on-write clone of infile.
 
-	binfile, tracks = get_extents(file(sys.argv[1]))
+	Returns False if the filesystem (or kernel) doesn't support it."""
+	try:
+		fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+	except (IOError, OSError):
+		return False
+	return True
 
-	if os.path.realpath(binfile) == os.path.realpath(sys.argv[2]):
-		print "Please specify a target filename different from the source filename."
-		sys.exit(2)
+def copy_range(infile, outfile, start, stop):
+	"""Copy [start, stop) from infile to the same offset in outfile, letting the
+	kernel do the work via copy_file_range() when possible."""
+	infile.flush(); outfile.flush()
+	in_fd, out_fd = infile.fileno(), outfile.fileno()
 
-	# Reverse the endianness on the audio tracks.
-	infile, outfile = file(binfile, 'rb'), file(sys.argv[2], 'wb')
-	while infile.tell() < tracks[0][0]:
-		temp = infile.read(min(CHUNK_SIZE, tracks[0][0] - infile.tell()))
-		outfile.write(temp)
-	if infile.tell() > tracks[0][0]:
-		raise Exception("Overshot our mark!")
+	if _copy_file_range is not None:
+		in_off, out_off = ctypes.c_int64(start), ctypes.c_int64(start)
+		while in_off.value < stop:
+			copied = _copy_file_range(in_fd, ctypes.byref(in_off),
+				out_fd, ctypes.byref(out_off), stop - in_off.value, 0)
+			if copied > 0:
+				continue
+			elif copied == 0:
+				raise Exception("Unexpected end of file at offset %d" % in_off.value)
+			elif ctypes.get_errno() in (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+					errno.EOPNOTSUPP):
+				start = in_off.value  # Fall back to userspace copying below
+				break
+			else:
+				err = ctypes.get_errno()
+				raise OSError(err, os.strerror(err))
+		else:
+			return
+
+	infile.seek(start); outfile.seek(start)
+	while start < stop:
+		chunk = infile.read(min(CHUNK_SIZE, stop - start))
+		if not chunk:
+			raise Exception("Unexpected end of file at offset %d" % start)
+		outfile.write(chunk)
+		start += len(chunk)
+
+def swab_range(infile, outfile, start, stop):
+	"""Byte-swap [start, stop) from infile into the same offset in outfile."""
+	if (stop - start) % 2 != 0:
+		raise Exception("Audio extent length not divisible by 2")
+
+	infile.seek(start); outfile.seek(start)
+	while start < stop:
+		report_progress(start)
+		chunk = infile.read(min(CHUNK_SIZE, stop - start))
+		if not chunk:
+			raise Exception("Unexpected end of file at offset %d" % start)
+		outfile.write(swab(chunk))
+		start += len(chunk)
+
+def swab_in_place(fh, tracks):
+	"""Byte-swap the given extents of an open read-write file via mmap."""
+	mapped = mmap.mmap(fh.fileno(), 0)
+	try:
+		for start, stop in tracks:
+			if (stop - start) % 2 != 0:
+				raise Exception("Audio extent length not divisible by 2")
+			for offset in range(start, stop, CHUNK_SIZE):
+				report_progress(offset)
+				end = min(offset + CHUNK_SIZE, stop)
+				mapped[offset:end] = swab(mapped[offset:end])
+		mapped.flush()
+	finally:
+		mapped.close()
+
+def pread(fd, size, offset):
+	buf = ctypes.create_string_buffer(size)
+	count = _libc.pread(fd, buf, size, offset)
+	if count < 0:
+		err = ctypes.get_errno()
+		raise OSError(err, os.strerror(err))
+	return buf.raw[:count]
+
+def pwrite(fd, data, offset):
+	while data:
+		count = _libc.pwrite(fd, data, len(data), offset)
+		if count < 0:
+			err = ctypes.get_errno()
+			raise OSError(err, os.strerror(err))
+		data, offset = data[count:], offset + count
+
+def split_extents(tracks, unit_size=WORK_UNIT_SIZE):
+	"""Break (start, stop) extents into independent units of at most unit_size."""
 	for start, stop in tracks:
-		offset = infile.tell()
-		while offset < stop:
-			sys.stdout.write('\rProcessing offset %s' %
-				 locale.format('%d', offset, grouping=True))
-			amount = min(CHUNK_SIZE, stop - infile.tell())
-			if amount % 2 != 0:
-				raise Exception("Remaining byte count not divisible by 2")
-
-			chunk = infile.read(amount)
-			for chunk_offset in range(0, amount, 2):
-				outfile.write(chunk[chunk_offset + 1] + chunk[chunk_offset])
-			offset = infile.tell()
-		sys.stdout.write('\rDone.                                   \n')
-
-	infile.close(); outfile.close()
+		if (stop - start) % 2 != 0:
+			raise Exception("Audio extent length not divisible by 2")
+		for offset in range(start, stop, unit_size):
+			yield offset, min(offset + unit_size, stop)
+
+def swab_parallel(in_fd, out_fd, tracks, jobs):
+	"""Byte-swap the given extents using a pool of jobs threads.
+
+	Each work unit is read and written at explicit offsets, so in_fd and out_fd
+	may be the same descriptor and no file position is shared."""
+	from multiprocessing.pool import ThreadPool
+
+	def swab_unit(unit):
+		start, stop = unit
+		data = pread(in_fd, stop - start, start)
+		if len(data) != stop - start:
+			raise Exception("Unexpected end of file at offset %d" % (start + len(data)))
+		pwrite(out_fd, swab(data), start)
+		return start
+
+	pool = ThreadPool(jobs)
+	try:
+		for offset in pool.imap_unordered(swab_unit, split_extents(tracks)):
+			report_progress(offset)
+	finally:
+		pool.terminate()
+
+def swab_copy(binfile, target, tracks, jobs=1):
+	"""Write a copy of binfile to target with the given extents byte-swapped.
+
+	Data regions never pass through Python if the kernel can help it."""
+	infile, outfile = open(binfile, 'rb'), open(target, 'w+b')
+	try:
+		if reflink(infile, outfile):
+			if jobs > 1:
+				swab_parallel(outfile.fileno(), outfile.fileno(), tracks, jobs)
+			else:
+				swab_in_place(outfile, tracks)
+			return
+
+		size, offset = os.fstat(infile.fileno()).st_size, 0
+		for start, stop in tracks:
+			if offset > start:
+				raise Exception("Overshot our mark!")
+			copy_range(infile, outfile, offset, start)
+			if jobs <= 1:
+				swab_range(infile, outfile, start, stop)
+			offset = stop
+		copy_range(infile, outfile, offset, size)
+		outfile.flush()
+
+		if jobs > 1:
+			swab_parallel(infile.fileno(), outfile.fileno(), tracks, jobs)
+		outfile.truncate(size)
+	finally:
+		infile.close(); outfile.close()
+
+def swab_stream(binfile, outfile, tracks):
+	"""Write the converted image sequentially to a non-seekable outfile.
+
+	Returns a list of (name, hexdigest) pairs for the data written, calculated
+	as it goes so the output never has to be read back."""
+	hashers, crc = [hashlib.md5(), hashlib.sha1()], 0
+
+	def emit(chunk):
+		outfile.write(chunk)
+		for hasher in hashers:
+			hasher.update(chunk)
+		return zlib.crc32(chunk, crc)
+
+	with open(binfile, 'rb') as infile:
+		offset, extents = 0, iter(tracks)
+		start, stop = next(extents, (None, None))
+		while True:
+			if start is not None and offset >= start:
+				if (stop - start) % 2 != 0:
+					raise Exception("Audio extent length not divisible by 2")
+				report_progress(offset)
+				chunk = infile.read(min(CHUNK_SIZE, stop - offset))
+				if not chunk:
+					raise Exception("Unexpected end of file at offset %d" % offset)
+				crc = emit(swab(chunk))
+			else:
+				limit = CHUNK_SIZE if start is None else min(CHUNK_SIZE, start - offset)
+				chunk = infile.read(limit)
+				if not chunk:
+					break
+				crc = emit(chunk)
+
+			offset += len(chunk)
+			if offset == stop:
+				start, stop = next(extents, (None, None))
+	outfile.flush()
+
+	return [(x.name.upper(), x.hexdigest()) for x in hashers] + [
+		('CRC32', '%08x' % (crc & 0xffffffff))]
+
+if __name__ == '__main__':
+	from optparse import OptionParser
+	parser = OptionParser(usage="%prog <cue file> <target bin file|->\n"
+		"       %prog --in-place <cue file>",
+		description=__doc__.strip().split('\n\n')[0])
+	parser.add_option('-i', '--in-place', action="store_true", dest="in_place",
+		default=False, help="Swap the audio tracks in the .BIN file referenced "
+		"by the cuesheet rather than writing a copy")
+	parser.add_option('-j', '--jobs', action="store", type="int", dest="jobs",
+		default=1, metavar="N", help="Swap audio in %d MiB work units on N "
+		"threads using pread/pwrite (default: %%default)" %
+		(WORK_UNIT_SIZE // (1024 * 1024)))
+	opts, args = parser.parse_args()
+
+	if len(args) != (1 if opts.in_place else 2):
+		parser.print_usage()
+		sys.exit(1)
+
+	binfile, tracks = get_extents(file(args[0]))
+	digests = []
+
+	if opts.in_place:
+		with open(binfile, 'r+b') as fh:
+			if opts.jobs > 1:
+				swab_parallel(fh.fileno(), fh.fileno(), tracks, opts.jobs)
+			else:
+				swab_in_place(fh, tracks)
+	elif args[1] == '-':
+		status = sys.stderr
+		digests = swab_stream(binfile, sys.stdout, tracks)
+	else:
+		if os.path.realpath(binfile) == os.path.realpath(args[1]):
+			print "Please specify a target filename different from the source filename."
+			print "(Or use --in-place to modify the source file directly.)"
+			sys.exit(2)
+		swab_copy(binfile, args[1], tracks, opts.jobs)
+	status.write('\rDone.                                   \n')
+	for name, digest in digests:
+		sys.stderr.write('%-6s %s\n' % (name + ':', digest))
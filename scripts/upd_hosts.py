@@ -1,72 +1,670 @@
 #!/usr/bin/env python3
 """upd_hosts.py
-Automatically generates /etc/hosts from /etc/hosts.local and the MVPS
-ad-blocking hosts list.
+Automatically generates /etc/hosts from /etc/hosts.local and one or more
+ad-blocking hosts lists. (By default, just the MVPS one.)
 
 Instructions:
 Put this file in /etc/cron.monthly and chmod it executable.
 
+By default, one blocked hostname is written per line. --format=compact packs
+several onto each 0.0.0.0 line to shrink what the resolver has to re-parse on
+every lookup, while --format=dnsmasq and --format=unbound write config files
+for a caching resolver, which loads the list into memory once instead.
+(Use --benchmark to compare lookup latency for each format on your lists.)
+
+If the regenerated output is byte-identical to what's already there, it isn't
+rewritten, so resolver caches keyed on its mtime stay valid. Otherwise, the
+number of hostnames added and removed since the last run is reported. (Use
+--verbose to list them)
+
+Every run also writes INDEX_FILE, a sorted binary index of the blocked
+hostnames and which sources block them, so that --check HOST... can answer
+"is this blocked, and by what?" with a binary search rather than a grep.
+The settings used to generate them (output format and path, whitelist and
+SOURCES) are recorded in SETTINGS_FILE so that changing any of them forces a
+rebuild even when the lists themselves haven't changed.
+
 Edit the ADHOST_SUFFIX_WHITELIST variable if you want. (Default is to allow
 only Project Wonderful because I respect them and they don't serve flash ads)
 
+Add other lists to SOURCES if you want. They're downloaded in parallel and
+the hostnames they block are merged into a single sorted, de-duplicated list.
+
+The last copy of each list is cached in CACHE_DIR along with its ETag and
+Last-Modified headers so that, if none of them have changed upstream and
+neither has /etc/hosts.local, /etc/hosts is left alone. (Safe to run more
+often than monthly.) The cache is only updated once the new /etc/hosts and
+index have been written, so a failed run is retried in full next time.
+
 TODO:
-- Use If-Modified-Since and ETags on the MVPS file so I can safely run this
-  more often. (Perhaps also use the ZIP download to save bandwidth?)
+- Perhaps use the ZIP download of the MVPS file to save bandwidth?
+- Make SOURCES configurable without editing the script.
 - Add a mode which doesn't require the local hosts file to be moved to
   /etc/hosts.local
 """
 
 MVPS_URL = 'http://winhelp2002.mvps.org/hosts.txt'
+SOURCES = {'mvps': MVPS_URL}  # name: URL
 LOCAL_HOSTS = '/etc/hosts.local'
 TARGET_HOSTS = '/etc/hosts'
+CACHE_DIR = '/var/cache/upd_hosts'
+INDEX_FILE = '/var/cache/upd_hosts/blocklist.idx'
+SETTINGS_FILE = '/var/cache/upd_hosts/settings.json'
 ADHOST_SUFFIX_WHITELIST = [b'.projectwonderful.com', b'piwik.org']
 
-import os, sys, urllib.request, urllib.error, urllib.parse  # NOQA: E401,E402
+ALLOWED_PREFIXES = (b'127.0.0.1 ', b'127.0.0.1\t', b'0.0.0.0 ', b'0.0.0.0\t')
+
+# Entries commonly found in downloaded lists which must never be blocked
+IGNORED_HOSTS = {b'localhost', b'localhost.localdomain', b'local',
+                 b'broadcasthost', b'ip6-localhost', b'ip6-loopback',
+                 b'0.0.0.0'}
+
+# Default number of hostnames per line for --format=compact. (Windows stops
+# reading a line after 9, so this keeps the output portable)
+HOSTS_PER_LINE = 9
+
+# Seconds to wait on a stalled connection before falling back to the cache
+FETCH_TIMEOUT = 60
+
+import argparse, hashlib, json, mmap, os, struct, sys, tempfile  # NOQA
+import time  # NOQA: E402
+import http.client, urllib.request, urllib.error, urllib.parse  # NOQA
+from concurrent.futures import ThreadPoolExecutor  # NOQA: E402
+
+# Trie node markers. (Can't collide with labels since those are never empty
+# and never contain dots)
+_MATCH_ALL, _SUBDOMAINS_ONLY = b'', b'.'
+
+# Binary index layout: header, source names (length-prefixed), one entry per
+# hostname (sorted), then the hostnames themselves, concatenated.
+INDEX_MAGIC = b'UPDHIDX1'
+_idx_header = struct.Struct('<8sII')  # magic, entry count, source count
+_idx_source = struct.Struct('<H')     # source name length
+_idx_entry = struct.Struct('<IHI')    # name offset, name length, source bits
 
 
 def checkStart(line):
-    """Only pass lines which are comments or 127.0.0.1 lines to ensure that
-    downloaded hosts lists can't be hijacked for DNS-based phishing.
+    """Only pass lines which are comments or 127.0.0.1/0.0.0.0 lines to ensure
+    that downloaded hosts lists can't be hijacked for DNS-based phishing.
 
-    Strip out lines which would block hosts in ADHOST_SUFFIX_WHITELIST."""
+    (Hosts in ADHOST_SUFFIX_WHITELIST are stripped out by parseHosts().)"""
     line = line.split(b'#', 1)[0].strip()  # Compare only the relevant portion.
 
-    for suffix in ADHOST_SUFFIX_WHITELIST:
-        if line.endswith(suffix.strip()):
-            return False  # Don't block whitelisted servers
+    # Allow 127.0.0.1/0.0.0.0 lines, comments, and blanks.
+    # Block everything else.
+    return not line or line.startswith(ALLOWED_PREFIXES)
+
+
+def buildSuffixTrie(suffixes):
+    """Build a trie of reversed domain labels for isWhitelisted().
+
+    A suffix with a leading dot (eg. .example.com) matches only subdomains.
+    One without (eg. example.com) also matches the domain itself."""
+    trie = {}
+    for suffix in suffixes:
+        suffix = suffix.strip().lower()
+        node = trie
+        for label in reversed(suffix.strip(b'.').split(b'.')):
+            node = node.setdefault(label, {})
+        marker = _SUBDOMAINS_ONLY if suffix.startswith(b'.') else _MATCH_ALL
+        node[marker] = True
+    return trie
+
+
+def isWhitelisted(host, trie):
+    """Check a normalized hostname against a trie from buildSuffixTrie() in
+    time proportional to its number of labels."""
+    labels = host.split(b'.')
+    node, remaining = trie, len(labels)
+    for label in reversed(labels):
+        node, remaining = node.get(label), remaining - 1
+        if node is None:
+            return False
+        if _MATCH_ALL in node or (remaining and _SUBDOMAINS_ONLY in node):
+            return True
+    return False
+
+
+WHITELIST_TRIE = buildSuffixTrie(ADHOST_SUFFIX_WHITELIST)
+
+
+def cachePaths(url):
+    """Return the (body, validators) paths used to cache the given URL."""
+    digest = hashlib.sha1(url.encode('utf8')).hexdigest()
+    base = os.path.join(CACHE_DIR, digest)
+    return base + '.txt', base + '.json'
+
+
+def hashFile(path):
+    """Return the SHA1 digest of the file at path or None if it's missing."""
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as fobj:
+            for block in iter(lambda: fobj.read(65536), b''):
+                digest.update(block)
+    except FileNotFoundError:
+        return None
+    return digest.digest()
+
+
+def replaceFile(path, chunks, mode=0o644):
+    """Write an iterable of bytes to path such that readers never see a
+    partial file, even if we crash or lose power part-way through.
+
+    If the new content is byte-identical to what's already there, the old
+    file is left untouched (mtime included) and False is returned."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+    try:
+        digest = hashlib.sha1()
+        with os.fdopen(fd, 'wb') as fobj:
+            for chunk in chunks:
+                fobj.write(chunk)
+                digest.update(chunk)
+            fobj.flush()
+
+            if digest.digest() == hashFile(path):
+                os.unlink(tmp_path)
+                return False
+
+            os.fchmod(fobj.fileno(), mode)
+            os.fsync(fobj.fileno())
+        os.rename(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return True
+
+
+def _cacheLines(response, body_path, meta_path, staged):
+    """Yield lines from response while saving them to a temporary file.
+
+    Once the whole response has been consumed, it's appended to staged for
+    commitCache() to move into place."""
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix='.')
+    try:
+        with os.fdopen(fd, 'wb') as fobj:
+            os.fchmod(fobj.fileno(), 0o644)  # Let --benchmark run unprivileged
+            for line in response:
+                fobj.write(line)
+                yield line
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    staged.append((tmp_path, body_path, meta_path, json.dumps({
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+    }).encode('utf8')))
+
+
+def commitCache(staged):
+    """Move downloads staged by _cacheLines() into the cache.
+
+    This must only happen once everything generated from them has been
+    written. Otherwise, a failed run would leave the cache claiming to be
+    current and the next run would skip regenerating the stale output.
+    (The body goes first so a crash in between merely costs a re-download)"""
+    while staged:
+        tmp_path, body_path, meta_path, validators = staged.pop()
+        os.rename(tmp_path, body_path)
+        replaceFile(meta_path, [validators])
+
+
+def discardCache(staged):
+    """Delete any downloads staged by _cacheLines() but never committed."""
+    while staged:
+        tmp_path = staged.pop()[0]
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def fetch(url, staged):
+    """Retrieve url, using the cached copy's validators to make the request
+    conditional.
+
+    Returns None if the server says our cached copy is still current.
+    Otherwise, returns an iterator over the lines of the response, which are
+    staged for caching as described in _cacheLines()."""
+    body_path, meta_path = cachePaths(url)
+
+    headers = {}
+    if os.path.exists(body_path):
+        try:
+            with open(meta_path) as fobj:
+                validators = json.load(fobj)
+        except (OSError, ValueError):
+            validators = {}
+
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    try:
+        response = urllib.request.urlopen(
+            urllib.request.Request(url, headers=headers),
+            timeout=FETCH_TIMEOUT)
+    except urllib.error.HTTPError as err:
+        if err.code == 304:
+            return None
+        raise
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    return _cacheLines(response, body_path, meta_path, staged)
+
+
+def parseHosts(lines, whitelist=None):
+    """Return the normalized set of hostnames blocked by a hosts list, minus
+    any matched by the given trie. (Defaults to WHITELIST_TRIE)
+
+    Lines are consumed one at a time so the raw list is never held in memory.
+    """
+    if whitelist is None:
+        whitelist = WHITELIST_TRIE
+
+    hostnames = set()
+    for line in lines:
+        # Play it safe by filtering out any non-127.0.0.1, non-comment lines.
+        if not checkStart(line):
+            continue
+        for host in line.split(b'#', 1)[0].split()[1:]:
+            host = host.lower().rstrip(b'.')
+            if host in IGNORED_HOSTS or isWhitelisted(host, whitelist):
+                continue
+            hostnames.add(host)
+    return hostnames
+
+
+def parseCached(url):
+    """Parse the cached copy of the list at url."""
+    with open(cachePaths(url)[0], 'rb') as fobj:
+        return parseHosts(fobj)
+
+
+def fetchHosts(url, staged):
+    """Download and parse the list at url if it has changed upstream.
+
+    Returns None if our cached copy is still current."""
+    # (The body is streamed, so connection errors can also surface while it's
+    # being parsed. URLError and socket.timeout are both OSErrors.)
+    try:
+        lines = fetch(url, staged)
+        return None if lines is None else parseHosts(lines)
+    except (OSError, http.client.HTTPException) as err:
+        if not os.path.exists(cachePaths(url)[0]):
+            raise
+        print("WARNING: Using cached copy of %s: %s" % (url, err),
+              file=sys.stderr)
+        return parseCached(url)
+
+
+def fetchAll(sources, staged):
+    """Retrieve and parse all sources concurrently, staging any new downloads
+    in staged. (See commitCache)
+
+    Returns a name-to-hostnames dict or None if nothing changed upstream."""
+    with ThreadPoolExecutor(max_workers=len(sources) or 1) as pool:
+        futures = {name: pool.submit(fetchHosts, url, staged)
+                   for name, url in sources.items()}
+        results = {name: future.result() for name, future in futures.items()}
+
+    if all(x is None for x in results.values()):
+        return None
+
+    for name, hostnames in results.items():
+        if hostnames is None:
+            results[name] = parseCached(sources[name])
+    return results
 
-    for prefix in (b'#', b'127.0.0.1 ', b'127.0.0.1\t',
-            b'0.0.0.0 ', b'0.0.0.0\t'):
-        if not line or line.strip().startswith(prefix):
-            return True  # Allow 127.0.0.1/0.0.0.0 lines, comments, and blanks.
-    return False  # Block everything else.
 
+def generate(localhosts, hostnames, per_line=1):
+    """Yield the lines of the new hosts file, packing per_line hostnames onto
+    each line."""
+    yield b"# WARNING: This file was auto-generated.\n"
+    yield (b"# Please edit /etc/hosts.local and run %s instead\n\n" %
+        os.path.split(sys.argv[0])[1].encode('utf8'))
 
-if os.geteuid() == 0:
-    # Retrieve the MVPS hosts file and play it safe
-    # by filtering out any non-127.0.0.1, non-comment lines.
-    adhosts_raw = urllib.request.urlopen(MVPS_URL).read().strip()
-    adhosts_raw = adhosts_raw.replace(b'\r', b'').split(b'\n')
-    adhosts = [x for x in adhosts_raw if checkStart(x)]
+    for line in localhosts:
+        yield line.rstrip(b'\r\n') + b'\n'
+    yield b'\n'
 
-    # integrate local definitions if this is the first time we're being run
-    if os.path.exists(TARGET_HOSTS) and not os.path.exists(LOCAL_HOSTS):
-        os.rename(TARGET_HOSTS, LOCAL_HOSTS)
+    hostnames = sorted(hostnames)
+    for pos in range(0, len(hostnames), per_line):
+        yield b'0.0.0.0 ' + b' '.join(hostnames[pos:pos + per_line]) + b'\n'
 
-    # Load the local hosts file from /etc/hosts.local
-    if os.path.exists(LOCAL_HOSTS):
-        localhosts = open(LOCAL_HOSTS, 'rb').read().strip().split(b'\n')
+
+def generateDnsmasq(hostnames):
+    """Yield the lines of a dnsmasq config file blocking the given hostnames.
+
+    (Note that dnsmasq's address= also blocks subdomains.)"""
+    yield (b"# WARNING: This file was auto-generated by %s\n\n" %
+        os.path.split(sys.argv[0])[1].encode('utf8'))
+    for host in sorted(hostnames):
+        yield b'address=/' + host + b'/0.0.0.0\n'
+
+
+def generateUnbound(hostnames):
+    """Yield the lines of an unbound config include blocking the given
+    hostnames."""
+    yield (b"# WARNING: This file was auto-generated by %s\n\nserver:\n" %
+        os.path.split(sys.argv[0])[1].encode('utf8'))
+    for host in sorted(hostnames):
+        yield b'    local-zone: "' + host + b'" always_null\n'
+
+
+#: format: (needs local hosts?, default output path)
+FORMATS = {
+    'hosts': (True, TARGET_HOSTS),
+    'compact': (True, TARGET_HOSTS),
+    'dnsmasq': (False, '/etc/dnsmasq.d/upd_hosts.conf'),
+    'unbound': (False, '/etc/unbound/unbound.conf.d/upd_hosts.conf'),
+}
+
+
+def render(fmt, localhosts, hostnames, per_line=HOSTS_PER_LINE):
+    """Return an iterator over the chunks of output for the given format."""
+    if fmt == 'dnsmasq':
+        return generateDnsmasq(hostnames)
+    elif fmt == 'unbound':
+        return generateUnbound(hostnames)
+    return generate(localhosts, hostnames, per_line if fmt == 'compact' else 1)
+
+
+def _scanHosts(data, host):
+    """Emulate glibc's files backend, which re-parses /etc/hosts linearly on
+    every lookup."""
+    for line in data.split(b'\n'):
+        fields = line.split(b'#', 1)[0].split()
+        if host in fields[1:]:
+            return fields[0]
+    return None
+
+
+def _loadZones(data, fmt):
+    """Emulate a caching resolver loading its config into memory once."""
+    zones = set()
+    for line in data.split(b'\n'):
+        line = line.strip()
+        if fmt == 'dnsmasq' and line.startswith(b'address=/'):
+            zones.add(line.split(b'/')[1])
+        elif fmt == 'unbound' and line.startswith(b'local-zone:'):
+            zones.add(line.split(b'"')[1])
+    return zones
+
+
+def _lookupZone(zones, host):
+    labels = host.split(b'.')
+    for pos in range(len(labels)):
+        if b'.'.join(labels[pos:]) in zones:
+            return b'0.0.0.0'
+    return None
+
+
+def benchmark(hostnames, lookups=50, per_line=HOSTS_PER_LINE):
+    """Compare (in-process, emulated) lookup latency for each output format.
+
+    Half the lookups are for blocked hosts and half are misses, which are the
+    worst case for a linear scan."""
+    import random
+    hosts = random.sample(sorted(hostnames), min(lookups // 2, len(hostnames)))
+    hosts += [b'miss%d.invalid' % x for x in range(lookups - len(hosts))]
+
+    print("%-8s %12s %12s %14s" % ('Format', 'Size (KiB)', 'Load (ms)',
+                                   'Lookup (ms)'))
+    for fmt in sorted(FORMATS):
+        data = b''.join(render(fmt, [], hostnames, per_line))
+
+        start = time.perf_counter()
+        if FORMATS[fmt][0]:
+            load_time, lookup = 0, lambda host: _scanHosts(data, host)
+        else:
+            zones = _loadZones(data, fmt)
+            load_time = time.perf_counter() - start
+            lookup = lambda host: _lookupZone(zones, host)  # NOQA: E731
+
+        start = time.perf_counter()
+        for host in hosts:
+            lookup(host)
+        lookup_time = (time.perf_counter() - start) / len(hosts)
+
+        print("%-8s %12d %12.2f %14.4f" % (fmt, len(data) // 1024,
+            load_time * 1000, lookup_time * 1000))
+
+
+def generateIndex(results):
+    """Yield the chunks of a binary index for a name-to-hostnames dict."""
+    sources = sorted(results)
+    if len(sources) > 32:  # Source flags are stored in a 32-bit field
+        raise ValueError("Too many sources for the index format")
+
+    masks = {}
+    for bit, name in enumerate(sources):
+        for host in results[name]:
+            masks[host] = masks.get(host, 0) | (1 << bit)
+    hostnames = sorted(masks)
+
+    yield _idx_header.pack(INDEX_MAGIC, len(hostnames), len(sources))
+    for name in sources:
+        name = name.encode('utf8')
+        yield _idx_source.pack(len(name)) + name
+
+    offset = 0
+    for host in hostnames:
+        yield _idx_entry.pack(offset, len(host), masks[host])
+        offset += len(host)
+    for host in hostnames:
+        yield host
+
+
+def _readIndexHeader(index):
+    """Return (entry count, source names, entries offset, names offset) for
+    the given mapped index."""
+    magic, count, source_count = _idx_header.unpack_from(index, 0)
+    if magic != INDEX_MAGIC:
+        raise ValueError("Not a blocklist index")
+
+    sources, pos = [], _idx_header.size
+    for _ in range(source_count):
+        length = _idx_source.unpack_from(index, pos)[0]
+        pos += _idx_source.size
+        sources.append(index[pos:pos + length].decode('utf8'))
+        pos += length
+    return count, sources, pos, pos + count * _idx_entry.size
+
+
+def indexedHosts(path):
+    """Return the set of hostnames in the index at path. (Empty if missing)"""
+    try:
+        fobj = open(path, 'rb')
+    except FileNotFoundError:
+        return set()
+
+    with fobj, mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ) as index:
+        count, _, entries, names = _readIndexHeader(index)
+        return {index[names + offset:names + offset + length]
+                for offset, length, _ in _idx_entry.iter_unpack(
+                    index[entries:names])}
+
+
+def checkIndex(path, hostnames):
+    """Yield (hostname, source names) pairs for each of the given hostnames by
+    binary searching the memory-mapped index at path.
+
+    Only the few pages actually touched by each search are read from disk."""
+    with open(path, 'rb') as fobj, \
+            mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ) as index:
+        count, sources, entries, names = _readIndexHeader(index)
+
+        for host in hostnames:
+            host = host.encode('utf8').lower().rstrip(b'.')
+            low, high, found = 0, count, []
+            while low < high:
+                mid = (low + high) // 2
+                offset, length, mask = _idx_entry.unpack_from(
+                    index, entries + mid * _idx_entry.size)
+                name = index[names + offset:names + offset + length]
+                if name < host:
+                    low = mid + 1
+                elif name > host:
+                    high = mid
+                else:
+                    found = [x for bit, x in enumerate(sources)
+                             if mask & (1 << bit)]
+                    break
+            yield host.decode('utf8'), found
+
+
+def check(hostnames):
+    """Report whether each hostname is blocked and by which sources.
+
+    Returns True if all of them are blocked."""
+    all_blocked = True
+    for host, sources in checkIndex(INDEX_FILE, hostnames):
+        if sources:
+            print("%s: blocked by %s" % (host, ', '.join(sources)))
+        else:
+            print("%s: not blocked" % host)
+            all_blocked = False
+    return all_blocked
+
+
+def settingsFingerprint(args, target):
+    """Return a serialized record of everything besides the downloaded lists
+    and /etc/hosts.local which affects the output."""
+    return json.dumps({
+        'format': args.format,
+        'per_line': args.per_line,
+        'target': os.path.abspath(target),
+        'whitelist': sorted(x.decode('utf8')
+                            for x in ADHOST_SUFFIX_WHITELIST),
+        'sources': SOURCES,
+    }, sort_keys=True).encode('utf8')
+
+
+def readSettings():
+    """Return the contents of SETTINGS_FILE or None if it's missing."""
+    try:
+        with open(SETTINGS_FILE, 'rb') as fobj:
+            return fobj.read()
+    except FileNotFoundError:
+        return None
+
+
+def main(args):
+    staged = []
+    try:
+        update(args, staged)
+        commitCache(staged)
+    finally:
+        discardCache(staged)
+
+
+def update(args, staged):
+    """Regenerate the output and index if anything they depend on changed.
+
+    New downloads are left in staged for the caller to commit on success."""
+    target = args.output or FORMATS[args.format][1]
+    use_local = FORMATS[args.format][0]
+    settings = settingsFingerprint(args, target)
+
+    # Retrieve the blocklists
+    results = fetchAll(SOURCES, staged)
+    if results is None:
+        # Unchanged upstream, so only regenerate if our settings changed or
+        # hosts.local was edited.
+        up_to_date = all(os.path.exists(x) for x in (target, INDEX_FILE))
+        up_to_date = up_to_date and readSettings() == settings
+        local_edited = False
+        if up_to_date and use_local and os.path.exists(LOCAL_HOSTS):
+            local_mtime = os.path.getmtime(LOCAL_HOSTS)
+            local_edited = local_mtime > os.path.getmtime(target)
+        if up_to_date and not local_edited:
+            print("Hosts lists not modified. Leaving %s alone." % target)
+            return
+        results = {name: parseCached(url) for name, url in SOURCES.items()}
+    adhosts = set().union(*results.values())
+
+    localhosts = []
+    if use_local:
+        # integrate local definitions if this is the first time we're being run
+        # (Hard-linked rather than renamed so /etc/hosts never goes missing.)
+        # (Only when writing /etc/hosts itself since -o could point anywhere)
+        if target == TARGET_HOSTS and not os.path.exists(LOCAL_HOSTS):
+            if os.path.exists(TARGET_HOSTS):
+                os.link(TARGET_HOSTS, LOCAL_HOSTS)
+
+        # Load the local hosts file from /etc/hosts.local
+        if os.path.exists(LOCAL_HOSTS):
+            localhosts = open(LOCAL_HOSTS, 'rb')
+
+    # Atomically replace the target with the new stuff (if it differs)
+    if replaceFile(target, render(args.format, localhosts, adhosts,
+                                  args.per_line)):
+        print("Updated %s" % target)
     else:
-        localhosts = []
+        print("%s is already up to date. Leaving it alone." % target)
+
+    # Report what changed since the last run, using the previous index
+    old_hosts = indexedHosts(INDEX_FILE)
+    added, removed = adhosts - old_hosts, old_hosts - adhosts
+    print("Blocked hosts: %d (%d added, %d removed)" % (
+        len(adhosts), len(added), len(removed)))
+    if args.verbose:
+        for prefix, hosts in (('+', added), ('-', removed)):
+            for host in sorted(hosts):
+                print(prefix + host.decode('utf8', 'replace'))
 
-    warning = [b"# WARNING: This file was auto-generated.",
-    b"# Please edit /etc/hosts.local and run "
-    b"%s instead" % os.path.split(sys.argv[0])[1].encode('utf8')]
+    os.makedirs(os.path.dirname(INDEX_FILE), exist_ok=True)
+    replaceFile(INDEX_FILE, generateIndex(results))
+    replaceFile(SETTINGS_FILE, [settings])
 
-    output = b'\n'.join(warning + [b''] + localhosts + [b''] + adhosts)
 
-    # Write the new stuff to /etc/hosts
-    open(TARGET_HOSTS, 'wb').write(output)
-else:
-    print("Re-calling via sudo to gain root privileges...")
-    os.execvp('sudo', ['sudo', str(__file__)])
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0].split('\n', 1)[1])
+    parser.add_argument('--format', choices=sorted(FORMATS), default='hosts',
+        help="Output format (default: %(default)s)")
+    parser.add_argument('-o', '--output', metavar='PATH', default=None,
+        help="Where to write the output (default depends on --format)")
+    parser.add_argument('--per-line', type=int, default=HOSTS_PER_LINE,
+        metavar='N', help="Hostnames per line for --format=compact "
+                          "(default: %(default)s)")
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+        help="List the hostnames added and removed since the last run")
+    parser.add_argument('--benchmark', action='store_true', default=False,
+        help="Compare emulated lookup latency for each format using the "
+             "cached lists instead of updating anything")
+    parser.add_argument('--check', nargs='+', metavar='HOST', default=None,
+        help="Report whether the given hosts are blocked, and by which "
+             "sources, using the index from the last run. (Exits with status "
+             "1 if any aren't)")
+    parser.add_argument('--lookups', type=int, default=50, metavar='N',
+        help="Number of lookups per format for --benchmark "
+             "(default: %(default)s)")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parseArgs()
+    if args.check:
+        try:
+            sys.exit(0 if check(args.check) else 1)
+        except FileNotFoundError:
+            print("No index found. Please run %s once first." %
+                  os.path.split(sys.argv[0])[1], file=sys.stderr)
+            sys.exit(2)
+    elif args.benchmark:
+        try:
+            benchmark(set().union(*[parseCached(url)
+                                    for url in SOURCES.values()]),
+                      args.lookups, args.per_line)
+        except FileNotFoundError:
+            print("No cached lists found. Please run %s once first." %
+                  os.path.split(sys.argv[0])[1], file=sys.stderr)
+            sys.exit(1)
+    elif os.geteuid() == 0:
+        main(args)
+    else:
+        print("Re-calling via sudo to gain root privileges...")
+        os.execvp('sudo', ['sudo', str(__file__)] + sys.argv[1:])